@@ -26,10 +26,59 @@ class Num(AST):
         self.value = token.value
 
 
+class Attr(AST):
+    """
+    Represents the ATTR placeholder in the AST.
+    Its value is supplied by the interpreter at evaluation time.
+    """
+    def __init__(self, token):
+        self.token = token
+
+
 class Regex(AST):
     """
     Represents a regex operation in the AST.
     """
     def __init__(self, attr, pattern):
         self.attr = attr
-        self.pattern = pattern
\ No newline at end of file
+        self.pattern = pattern
+
+
+def count_nodes(tree):
+    """Counts the nodes of an AST."""
+    count = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        count += 1
+        if isinstance(node, BinOp):
+            stack.append(node.left)
+            stack.append(node.right)
+    return count
+
+
+def is_arithmetic(tree):
+    """Returns True if the tree only contains arithmetic nodes (no Regex)."""
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, BinOp):
+            stack.append(node.left)
+            stack.append(node.right)
+        elif not isinstance(node, (Num, Attr)):
+            return False
+    return True
+
+
+def regex_patterns(tree):
+    """Returns the patterns of every Regex node in the tree."""
+    patterns = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, BinOp):
+            stack.append(node.right)
+            stack.append(node.left)
+        elif isinstance(node, Regex):
+            patterns.append(node.pattern.value)
+    return patterns
@@ -1,13 +1,38 @@
-import json
-import time
-from database import SQLiteDataSink
-from django_database import get_expression
-from interpreter import *
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import zlib
+from collections import deque
+from time import perf_counter
+from database import SYNCHRONOUS_MODES, SQLiteDataSink, read_checkpoint
+from django_database import asset_registry, expression_map, get_expression
+from compiler import BACKENDS, ExpressionCache
+from AST import Regex
+from regex_cache import MultiPatternMatcher, pattern_cache, pattern_guard
+from vectorized import evaluate_batch, is_vectorizable
+from metrics import MetricsExporter, PipelineMetrics, pipeline_metrics
+from file_watcher import WATCH_MODES, create_watcher
+from records import JSON_DECODERS, Record, record_decoder
+from pipeline import OutputBuffer, StagedPipeline
+import vectorized
 
-def process_message(message, equation):
+# Compiled expressions shared by every message, keyed by the expression text
+expression_cache = ExpressionCache()
 
-    message_obj = json.loads(message)
-    attr_value = message_obj.get("value", "")  # Get returns default value if not found
+def process_message(message, equation, cache=expression_cache, metrics=pipeline_metrics, decoder=record_decoder):
+    """Decodes a raw input record and evaluates it with its equation, returns the output message."""
+    start = perf_counter()
+    record = decoder.decode(message)
+    metrics.observe('decode', perf_counter() - start)
+    return evaluate_record(record, equation, cache, metrics)
+
+
+def evaluate_record(record, equation, cache=expression_cache, metrics=pipeline_metrics):
+    """Evaluates a decoded Record with its equation, returns the output message."""
+    attr_value = record.value
 
     # Check if attr_value is numeric
     try:
@@ -15,91 +40,684 @@ def process_message(message, equation):
     except ValueError:
         numeric_value = None
 
-    try:
-        lexer = Lexer(equation)
-    except Exception as e:
+    if not equation:
         raise Exception("Asset not linked to a KPI")
 
-    parser = Parser(lexer)
-
     try:
         if "Regex" in equation:  # Handles regex equations
-            interpreter = Interpreter(parser, attr_value)
+            value = attr_value
         else:  # Handles arithmetic equations
             if numeric_value is None:
                 raise ValueError(f"Non-numeric value '{attr_value}' cannot be used in arithmetic equations")
-            parser.attr_value = numeric_value  # Pass numeric value to parser
-            interpreter = Interpreter(parser, str(numeric_value))
+            value = numeric_value
 
-        tree = parser.parse()
-        if tree is None:  # Ensuring tree is valid
-            raise Exception("Failed to parse equation: Invalid AST")
-
-        result = interpreter.visit(tree)
-
-        output_message = {
-            "asset_id": message_obj["asset_id"],
-            "attribute_id": "output_" + message_obj["attribute_id"],
-            "timestamp": message_obj["timestamp"],
-            "value": result
-        }
-        return output_message
+        start = perf_counter()
+        compiled = cache.get(equation)
+        found = perf_counter()
+        result = compiled.evaluate(value)
+        metrics.observe('expression_cache', found - start)
+        metrics.observe('evaluate', perf_counter() - found)
+        return build_output(record, result)
 
     except Exception as e:
         raise Exception(f"Error processing message: {e}")
 
 
+def build_output(record, result):
+    """Builds the output message for a decoded input Record and its KPI result."""
+    output_message = {
+        "asset_id": record.asset_id,
+        "attribute_id": "output_" + record.attribute_id,
+        "timestamp": record.timestamp,
+        "value": result
+    }
+    return output_message
+
+
 class FileReader:
-    def __init__(self, file_path):
+    """
+    Streams the records appended to a file, at most batch_size records per read.
+    The file is read in binary chunks of chunk_size bytes as records are needed, so memory stays
+    bounded however far behind the reader is. last_position is the byte offset after the last
+    record returned, and a trailing line without its newline is kept until it is completed.
+    Lines longer than max_line_length are skipped.
+    The file stays open and is identified by its inode: when the path is replaced by a new
+    file (rotation) the rest of the old file is read before switching to the new one from its
+    start, and when the file shrinks (truncation) it is read again from the start.
+    """
+    def __init__(self, file_path, batch_size=10000, chunk_size=1 << 20, max_line_length=1 << 24):
         self.file_path = file_path
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.max_line_length = max_line_length
         self.last_position = 0
+        self.file = None
+        self.inode = None
+        self.lines = deque()  # (line, bytes it takes in the file) read but not returned yet
+        self.partial = b''  # Start of a line whose newline was not read yet
+        self.pending_bytes = 0  # Bytes read from the file but not returned yet
+        self.skipping = False  # Inside a line longer than max_line_length
+        self.rotations = 0
+        self.truncations = 0
+        self.skipped_lines = 0
 
     def read_new_records(self):
-        """Read new records from the file starting from the last position."""
-        with open(self.file_path, "r") as file:
-            file.seek(self.last_position)
-            records = file.readlines()
-            self.last_position = file.tell()
-        return [record.strip() for record in records if record.strip()]
+        """Read new records from the file starting from the last position, at most batch_size of them."""
+        if self.file is None and not self._open():
+            return []
+
+        records = []
+        while len(records) < self.batch_size:
+            if not self.lines and (self.file is None or not self._read_chunk()):
+                break
+            line, size = self.lines.popleft()
+            self.pending_bytes -= size
+            line = line.strip()
+            if line:
+                records.append(line.decode("utf-8", errors="replace"))
+        if self.file is not None:
+            self.last_position = self.file.tell() - self.pending_bytes
+        return records
+
+    def _open(self):
+        """Opens the file from its start, returns False if it does not exist."""
+        try:
+            self.file = open(self.file_path, "rb")
+        except FileNotFoundError:
+            return False
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.last_position = 0
+        self._reset()
+        return True
+
+    def _reset(self):
+        self.partial = b''
+        self.pending_bytes = 0
+        self.skipping = False
+
+    def _read_chunk(self):
+        """Reads chunks until one completes a line, returns False at the end of the file."""
+        while True:
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                if not self._reopen_if_replaced():
+                    return False
+                if self.lines or self.file is None:
+                    return bool(self.lines)
+                continue
+            self.pending_bytes += len(chunk)
+            self._split(chunk)
+            if self.lines:
+                return True
+
+    def _split(self, chunk):
+        """Adds the complete lines of the chunk to self.lines and keeps the rest as partial."""
+        if self.skipping:
+            newline = chunk.find(b'\n')
+            if newline == -1:
+                self.pending_bytes -= len(chunk)
+                return
+            self.pending_bytes -= newline + 1
+            chunk = chunk[newline + 1:]
+            self.skipping = False
+
+        lines = (self.partial + chunk).split(b'\n')
+        self.partial = lines.pop()
+        self.lines.extend((line, len(line) + 1) for line in lines)
+        if len(self.partial) > self.max_line_length:
+            self.pending_bytes -= len(self.partial)
+            self.partial = b''
+            self.skipping = True
+            self.skipped_lines += 1
+
+    def _reopen_if_replaced(self):
+        """
+        Called at the end of the file, handles its rotation or truncation.
+        Returns True if there may be more to read.
+        """
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:  # Moved away and not created again yet
+            return False
+        if stat.st_ino != os.fstat(self.file.fileno()).st_ino:
+            if self.partial and not self.skipping:  # Nothing is appended to a rotated file, its last line is complete
+                self.lines.append((self.partial, 0))
+            self.file.close()
+            self.file = None
+            self.rotations += 1
+            self._open()
+            return True
+        if stat.st_size < self.file.tell():
+            self.file.seek(0)
+            self.last_position = 0
+            self._reset()
+            self.truncations += 1
+            return True
+        return False
+
+    def position(self):
+        """Returns (inode, last_position), stored by checkpoints to resume reading, or None before the file is opened."""
+        if self.inode is None:
+            return None
+        return self.inode, self.last_position
+
+    def seek(self, inode, offset):
+        """
+        Resumes reading at offset, a last_position of the file with the inode.
+        Returns False, and reads from the start, if the file was replaced or truncated since.
+        """
+        if self.file is None and not self._open():
+            return False
+        if self.inode != inode or os.fstat(self.file.fileno()).st_size < offset:
+            return False
+        self.file.seek(offset)
+        self.last_position = offset
+        self.lines.clear()
+        self._reset()
+        return True
+
+    def unread_bytes(self):
+        """Returns how many bytes of the file are behind the last position, the queue lag."""
+        try:
+            return max(os.path.getsize(self.file_path) - self.last_position, 0)
+        except OSError:
+            return 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 
 class DataProcessor:
-    def __init__(self, data_sink):
+    """
+    Evaluates input records with the KPI of their asset and writes the outputs to the data sink.
+    Every record is decoded once into a Record, which is what the evaluation steps receive.
+    With an asset_registry, the asset_ids of each batch are registered in the Django database.
+    """
+    def __init__(self, data_sink, batch_mode=False, metrics=pipeline_metrics, decoder=record_decoder, echo=True,
+                 asset_registry=None):
         self.data_sink = data_sink
+        self.batch_mode = batch_mode
+        self.metrics = metrics
+        self.decoder = decoder
+        self.echo = echo  # Print every output message
+        self.asset_registry = asset_registry
 
     def process_records(self, records):
         """Processes a batch of records."""
+        self.metrics.records_read += len(records)
+        decoded = []
+        for line in records:
+            record = self.decode(line)
+            if record is not None:
+                decoded.append(record)
+        if self.asset_registry is not None:
+            try:
+                self.asset_registry.register(record.asset_id for record in decoded)
+            except Exception as e:  # Registered again with the next batch
+                print(f"Error registering assets, Error: {e}")
+        self.process_decoded(decoded)
+
+    def process_decoded(self, records):
+        """Processes a batch of decoded Records."""
+        if self.batch_mode:
+            self.process_batch(records)
+            return
+
         for record in records:
+            equation = None
             try:
                 # print("process_records",record)
-                asset_id = json.loads(record.strip())['asset_id']
-                output_message = process_message(record, get_expression(asset_id))
-                self.data_sink.write_message(output_message)
-                print(output_message)
+                start = perf_counter()
+                equation = get_expression(record.asset_id)
+                self.metrics.observe('lookup', perf_counter() - start)
+                output_message = evaluate_record(record, equation, metrics=self.metrics)
+                self.write(output_message)
+            except Exception as e:
+                self.report_error(record.raw, e, record.asset_id, equation)
+
+    def decode(self, line):
+        """Returns the Record of an input line, or None after reporting why it cannot be decoded."""
+        try:
+            start = perf_counter()
+            record = self.decoder.decode(line)
+            self.metrics.observe('decode', perf_counter() - start)
+            return record
+        except Exception as e:
+            self.report_error(line, e)
+            return None
+
+    def process_record(self, record, equation):
+        """Processes a single Record with its equation, writing the output or printing the error."""
+        try:
+            output_message = evaluate_record(record, equation, metrics=self.metrics)
+            self.write(output_message)
+        except Exception as e:
+            self.report_error(record.raw, e, record.asset_id, equation)
+
+    def write(self, output_message):
+        """Writes an output message to the sink and prints it."""
+        start = perf_counter()
+        self.data_sink.write_message(output_message)
+        self.metrics.observe('write', perf_counter() - start)
+        self.metrics.records_processed += 1
+        if self.echo:
+            print(output_message)
+
+    def report_error(self, record, error, asset_id=None, equation=None):
+        """Prints the error of a raw record and counts it for its asset and KPI."""
+        self.metrics.record_error(asset_id, equation)
+        print(f"Error processing record: {record}, Error: {error}")
+
+    def write_output(self, record, equation, result):
+        """Writes the output of a Record evaluated in batch mode, or prints the error."""
+        try:
+            output_message = build_output(record, result)
+        except Exception as e:
+            self.report_error(record.raw, f"Error processing message: {e}", record.asset_id, equation)
+            return
+        try:
+            self.write(output_message)
+        except Exception as e:
+            self.report_error(record.raw, e, record.asset_id, equation)
+
+    def process_batch(self, records):
+        """
+        Processes a batch of Records in batch mode.
+        Records are grouped by KPI expression and each arithmetic expression is evaluated
+        once over the values of its whole group (with NumPy when installed). Regex records are
+        matched against all the patterns of the batch at once.
+        Records of the same asset keep their order, records of different assets may not.
+        """
+        groups = {}
+        regex_members = []
+        for record in records:
+            try:
+                start = perf_counter()
+                equation = get_expression(record.asset_id)
+                self.metrics.observe('lookup', perf_counter() - start)
+            except Exception as e:
+                self.report_error(record.raw, e, record.asset_id)
+                continue
+            if not equation:
+                self.process_record(record, equation)  # Reports the asset as not linked
+            elif "Regex" in equation:
+                regex_members.append((record, equation))
+            else:
+                groups.setdefault(equation, []).append(record)
+
+        for equation, members in groups.items():
+            self.process_group(equation, members)
+        if regex_members:
+            self.process_regex_group(regex_members)
+
+    def process_group(self, equation, members):
+        """
+        Evaluates one arithmetic expression over a group of Records.
+        Errors are reported per record with the same messages as process_message.
+        """
+        try:
+            tree = expression_cache.get(equation).tree
+        except Exception as e:
+            for record in members:
+                self.report_error(record.raw, f"Error processing message: {e}", record.asset_id, equation)
+            return
+
+        if not vectorized.available or not is_vectorizable(tree):
+            for record in members:
+                self.process_record(record, equation)
+            return
+
+        numeric_members = []
+        numeric_values = []
+        for record in members:
+            try:
+                numeric_values.append(float(record.value))
+                numeric_members.append(record)
+            except (TypeError, ValueError):
+                self.report_error(record.raw, f"Error processing message: Non-numeric value '{record.value}' "
+                                              f"cannot be used in arithmetic equations", record.asset_id, equation)
+
+        start = perf_counter()
+        results = evaluate_batch(tree, numeric_values)
+        self.metrics.observe('evaluate_batch', perf_counter() - start)
+        for record, (result, error) in zip(numeric_members, results):
+            if error is not None:
+                self.report_error(record.raw, f"Error processing message: {error}", record.asset_id, equation)
+            else:
+                self.write_output(record, equation, result)
+
+    def process_regex_group(self, members):
+        """
+        Evaluates Regex KPIs over a group of (Record, equation) pairs.
+        Each distinct value is matched against every pattern of the group in one pass of a
+        MultiPatternMatcher. Equations that are more than a single Regex go through evaluate_record.
+        """
+        pattern_members = []
+        for record, equation in members:
+            try:
+                tree = expression_cache.get(equation).tree
+            except Exception:
+                tree = None
+            if not isinstance(tree, Regex) or not isinstance(record.value, str):
+                self.process_record(record, equation)
+                continue
+            try:
+                pattern_cache.get(tree.pattern.value)  # The matcher is only built from patterns that compile
             except Exception as e:
-                print(f"Error processing record: {record}, Error: {e}")
+                self.report_error(record.raw, f"Error processing message: {e}", record.asset_id, equation)
+                continue
+            pattern_members.append((record, equation, tree.pattern.value))
+
+        start = perf_counter()
+        matcher = MultiPatternMatcher(pattern for _, _, pattern in pattern_members)
+        matches = {}  # value -> {pattern: matched}
+        outputs = []
+        for record, equation, pattern in pattern_members:
+            results = matches.get(record.value)
+            if results is None:
+                try:
+                    results = matches[record.value] = matcher.match_all(record.value)
+                except Exception as e:  # e.g. a guarded pattern timing out
+                    self.report_error(record.raw, f"Error processing message: {e}", record.asset_id, equation)
+                    continue
+            outputs.append((record, equation, 'True' if results[pattern] else 'False'))
+        self.metrics.observe('evaluate_batch', perf_counter() - start)
+        for record, equation, result in outputs:
+            self.write_output(record, equation, result)
+
+    def close(self):
+        """Releases the resources of the processor, a single process one has none."""
+        pass
+
+
+# Kinds of the events a shard worker sends back for its records
+OUTPUT_EVENT, ERROR_EVENT = range(2)
+
+
+class ShardWorkerProcessor(DataProcessor):
+    """
+    DataProcessor of a shard worker process.
+    Outputs and errors are collected as events, in the order they happen, for the parent
+    process to write and report.
+    """
+    def __init__(self, batch_mode, metrics):
+        super().__init__(None, batch_mode=batch_mode, metrics=metrics)
+        self.events = []
+
+    def write(self, output_message):
+        self.events.append((OUTPUT_EVENT, output_message))
+
+    def report_error(self, record, error, asset_id=None, equation=None):
+        self.events.append((ERROR_EVENT, record, str(error), asset_id, equation))
+
+    def take_events(self):
+        events, self.events = self.events, []
+        return events
+
+
+def shard_worker(connection, batch_mode, backend, regex_timeout, expressions_db):
+    """
+    Runs in a shard worker process with its own expression cache and expression map.
+    Processes the batches of Record fields it receives until None is received or the pipe is closed.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Shutdown is driven by the parent process
+    expression_cache.set_backend(backend)
+    pattern_guard.timeout = regex_timeout
+    if expressions_db is not None:
+        expression_map.db_name = expressions_db
+    metrics = PipelineMetrics()
+    processor = ShardWorkerProcessor(batch_mode, metrics)
+    try:
+        while True:
+            try:
+                batch = connection.recv()
+            except EOFError:
+                break
+            if batch is None:
+                break
+            processor.process_decoded([Record(*fields) for fields in batch])
+            connection.send((processor.take_events(), metrics.take_stages()))
+    finally:
+        expression_map.close()
+        pattern_guard.close()
 
 
-def main():
+class ShardedProcessor(DataProcessor):
+    """
+    Processes records on several cores.
+    Records are decoded in this process and partitioned by the CRC32 of their asset_id over
+    dedicated worker processes, which look up and evaluate them. All the records of an asset go
+    to the same worker, so their outputs are written to the data sink in their input order.
+    A worker that exits is restarted, the records of its current batch are reported as failed.
+    """
+    def __init__(self, data_sink, workers, batch_mode=False, metrics=pipeline_metrics, decoder=record_decoder,
+                 backend='interpreter', regex_timeout=0.1, expressions_db=None, asset_registry=None):
+        super().__init__(data_sink, batch_mode=batch_mode, metrics=metrics, decoder=decoder,
+                         asset_registry=asset_registry)
+        self.context = multiprocessing.get_context('spawn')  # Workers do not inherit open connections
+        self.worker_args = (batch_mode, backend, regex_timeout, expressions_db)
+        self.connections = [None] * workers
+        self.processes = [None] * workers
+        self.restarts = 0
+        for index in range(workers):
+            self.start_worker(index)
+        self.metrics.add_collector("shards", self.stats)
+
+    def start_worker(self, index):
+        connection, worker_connection = self.context.Pipe()
+        process = self.context.Process(target=shard_worker, daemon=True, args=(worker_connection, *self.worker_args))
+        process.start()
+        worker_connection.close()
+        self.connections[index] = connection
+        self.processes[index] = process
+
+    def restart_worker(self, index, shard):
+        """Replaces a worker that exited and reports the records of the batch it was holding."""
+        self.connections[index].close()
+        self.processes[index].join(timeout=5)
+        self.start_worker(index)
+        self.restarts += 1
+        for raw, asset_id, *_ in shard:
+            self.report_error(raw, f"Shard worker {index} exited", asset_id)
+
+    def stats(self):
+        """Returns the worker counters as a dictionary."""
+        return {
+            "workers": len(self.processes),
+            "worker_restarts": self.restarts,
+        }
+
+    def shard(self, asset_id):
+        """Returns the index of the worker processing the records of the asset."""
+        return zlib.crc32(str(asset_id).encode()) % len(self.connections)
+
+    def process_decoded(self, records):
+        """Sends each worker the Records of its shard, then writes the outputs they send back."""
+        shards = [[] for _ in self.connections]
+        for record in records:
+            shards[self.shard(record.asset_id)].append(
+                (record.raw, record.asset_id, record.attribute_id, record.timestamp, record.value))
+
+        busy = []
+        for index, (connection, shard) in enumerate(zip(self.connections, shards)):
+            if shard:
+                try:
+                    connection.send(shard)
+                except OSError:  # The worker exited
+                    self.restart_worker(index, shard)
+                    continue
+                busy.append((index, connection))
+
+        for index, connection in busy:
+            try:
+                events, stages = connection.recv()
+            except (EOFError, OSError):
+                self.restart_worker(index, shards[index])
+                continue
+            self.metrics.merge_stages(stages)
+            for event in events:
+                if event[0] == ERROR_EVENT:
+                    self.report_error(*event[1:])
+                    continue
+                try:
+                    self.write(event[1])
+                except Exception as e:
+                    self.report_error(event[1], e, event[1]["asset_id"])
+
+    def close(self):
+        """Stops the workers once they finished their current batch."""
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:  # The worker already exited
+                pass
+        for connection, process in zip(self.connections, self.processes):
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            connection.close()
+        self.connections = []
+        self.processes = []
+
+
+def main(batch_mode=False, backend='interpreter', regex_timeout=0.1,
+         metrics_file="metrics.prom", metrics_json="metrics.json", metrics_interval=10.0,
+         sink_batch_size=500, sink_flush_interval=1.0, synchronous='NORMAL', watch='auto',
+         read_batch_size=10000, json_decoder='auto', workers=1, staged=False, queue_size=4,
+         checkpoint_interval=0.0):
     input_file = "djangoTask/data.txt"
     db_name = "processed_data.db" # DB to save the output on
     # config_file = "config.txt"
 
     # initialize dependencies
-    data_sink = SQLiteDataSink(db_name)
-    file_reader = FileReader(input_file)
+    expression_cache.set_backend(backend)
+    pattern_guard.timeout = regex_timeout
+    record_decoder.set_decoder(json_decoder)
+    file_reader = FileReader(input_file, batch_size=read_batch_size)
+    checkpoint = read_checkpoint(db_name, input_file)
+    if checkpoint is not None and file_reader.seek(*checkpoint):
+        print(f"Resuming {input_file} at byte {checkpoint[1]}")
+    watcher = create_watcher(input_file, watch)
+    pipeline_metrics.add_collector("expression_cache", expression_cache.stats)
+    pipeline_metrics.add_collector("pattern_cache", pattern_cache.stats)
+    pipeline_metrics.add_collector("regex_guard", pattern_guard.stats)
+    pipeline_metrics.add_collector("expression_map", expression_map.stats)
+    pipeline_metrics.add_collector("asset_registry", asset_registry.stats)
+    pipeline_metrics.add_collector("watcher", watcher.stats)
+    exporter = MetricsExporter(pipeline_metrics, metrics_file, metrics_json, metrics_interval)
+
+    def create_sink():
+        return SQLiteDataSink(db_name, batch_size=sink_batch_size, flush_interval=sink_flush_interval,
+                              wal=True, synchronous=synchronous, checkpoint_source=input_file,
+                              checkpoint_interval=checkpoint_interval)
 
-    # Create the processor
-    processor = DataProcessor(data_sink)
+    def create_processor(data_sink):
+        if workers > 1:
+            return ShardedProcessor(data_sink, workers, batch_mode=batch_mode, backend=backend,
+                                    regex_timeout=regex_timeout, asset_registry=asset_registry)
+        return DataProcessor(data_sink, batch_mode=batch_mode, asset_registry=asset_registry)
 
     try:
-        while True:
-            # Read new records every 5 seconds
-            new_records = file_reader.read_new_records()
-            processor.process_records(new_records)
-            time.sleep(5)
+        if staged:
+            # The data sink is created in the writer stage, which writes the outputs buffered by the processor
+            output_buffer = OutputBuffer()
+            processor = create_processor(output_buffer)
+            try:
+                pipeline = StagedPipeline(file_reader, watcher, processor, output_buffer, create_sink, exporter,
+                                          queue_size=queue_size, flush_interval=sink_flush_interval)
+                asyncio.run(pipeline.run())
+            finally:
+                processor.close()
+        else:
+            data_sink = create_sink()
+            pipeline_metrics.add_collector("sink", data_sink.stats)
+            processor = create_processor(data_sink)
+            try:
+                run_loop(file_reader, watcher, processor, data_sink, exporter, sink_flush_interval)
+            finally:
+                processor.close()
+                data_sink.close()  # Flushes the pending messages
     finally:
-        data_sink.close()
+        file_reader.close()
+        watcher.close()
+        expression_map.close()
+        asset_registry.close()
+        exporter.write()
+        pattern_guard.close()
+
+
+def run_loop(file_reader, watcher, processor, data_sink, exporter, flush_interval):
+    """Reads, processes and writes the new records one batch after the other, until interrupted."""
+    while True:
+        # Records are read as soon as the file changes. Under load, what was appended while
+        # the previous batch was processed makes up the next batch, up to the reader's batch size.
+        new_records = file_reader.read_new_records()
+        processor.process_records(new_records)
+        # The outputs of the batch are written, the checkpoint commits them with the position after it
+        data_sink.checkpoint(file_reader.position())
+        # Bytes appended while the batch was processed
+        pipeline_metrics.queue_lag_bytes = file_reader.unread_bytes()
+        exporter.write_if_due()
+        if not new_records:
+            # Wakes up at least every flush interval for the time-based flush of the sink
+            watcher.wait(flush_interval)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="Processes data records with their KPI expressions.")
+    arg_parser.add_argument("--batch", action="store_true",
+                            help="evaluate KPIs over whole batches (arithmetic KPIs with NumPy)")
+    arg_parser.add_argument("--backend", choices=BACKENDS, default="interpreter",
+                            help="how compiled expressions are evaluated")
+    arg_parser.add_argument("--regex-timeout", type=float, default=0.1,
+                            help="deadline in seconds of a match with a regex prone to catastrophic backtracking")
+    arg_parser.add_argument("--metrics-file", default="metrics.prom",
+                            help="Prometheus text file the metrics are periodically written to")
+    arg_parser.add_argument("--metrics-json", default="metrics.json",
+                            help="JSON snapshot of the metrics, served by the Django metrics endpoint")
+    arg_parser.add_argument("--metrics-interval", type=float, default=10.0,
+                            help="seconds between two writes of the metrics files")
+    arg_parser.add_argument("--sink-batch-size", type=int, default=500,
+                            help="output messages inserted per transaction, 1 commits every message")
+    arg_parser.add_argument("--sink-flush-interval", type=float, default=1.0,
+                            help="seconds a pending output message may wait before it is flushed")
+    arg_parser.add_argument("--synchronous", choices=SYNCHRONOUS_MODES, default="NORMAL",
+                            help="SQLite synchronous setting of the output database (in WAL mode)")
+    arg_parser.add_argument("--watch", choices=WATCH_MODES, default="auto",
+                            help="how changes of the input file are detected, inotify or adaptive polling")
+    arg_parser.add_argument("--read-batch-size", type=int, default=10000,
+                            help="most records read from the input file and processed at once")
+    arg_parser.add_argument("--json-decoder", choices=JSON_DECODERS, default="auto",
+                            help="JSON parser of the input records, auto uses orjson or msgspec when installed")
+    arg_parser.add_argument("--workers", type=int,
+                            help="worker processes evaluating the records, sharded by asset_id "
+                                 "(default 1, or one per CPU with --backfill)")
+    arg_parser.add_argument("--staged", action="store_true",
+                            help="run reading, evaluation and writing as concurrent asyncio stages")
+    arg_parser.add_argument("--queue-size", type=int, default=4,
+                            help="batches each stage of --staged may queue before the previous stage waits")
+    arg_parser.add_argument("--backfill", metavar="FILE",
+                            help="process the whole file with one worker per CPU, report the throughput and exit")
+    arg_parser.add_argument("--checkpoint-interval", type=float, default=0.0,
+                            help="most seconds between two stores of the read position with the outputs, "
+                                 "0 stores it with every flush")
+    args = arg_parser.parse_args()
+    if args.backfill:
+        from backfill import BackfillError, run_backfill  # Imported here, backfill imports this module
+        try:
+            run_backfill(args.backfill, workers=args.workers, batch_mode=args.batch, backend=args.backend,
+                         regex_timeout=args.regex_timeout, json_decoder=args.json_decoder,
+                         synchronous=args.synchronous, read_batch_size=args.read_batch_size)
+        except BackfillError as e:
+            print(e)
+            sys.exit(1)
+        sys.exit(0)
+    main(batch_mode=args.batch, backend=args.backend, regex_timeout=args.regex_timeout,
+         metrics_file=args.metrics_file, metrics_json=args.metrics_json, metrics_interval=args.metrics_interval,
+         sink_batch_size=args.sink_batch_size, sink_flush_interval=args.sink_flush_interval,
+         synchronous=args.synchronous, watch=args.watch,
+         read_batch_size=args.read_batch_size, json_decoder=args.json_decoder,
+         workers=args.workers or 1, staged=args.staged, queue_size=args.queue_size,
+         checkpoint_interval=args.checkpoint_interval)
\ No newline at end of file
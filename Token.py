@@ -1,6 +1,6 @@
 # Token types used in parsing and interpreting the equations
-INTEGER, PLUS, MINUS, MUL, DIV, LPAREN, RPAREN,  ATTR, REGEX, COMMA, STRING = (
-    'INTEGER', 'PLUS', 'MINUS', 'MUL', 'DIV', '(', ')', 'ATTR', 'REGEX', 'COMMA', 'STRING'
+INTEGER, FLOAT, PLUS, MINUS, MUL, DIV, LPAREN, RPAREN,  ATTR, REGEX, COMMA, STRING = (
+    'INTEGER', 'FLOAT', 'PLUS', 'MINUS', 'MUL', 'DIV', '(', ')', 'ATTR', 'REGEX', 'COMMA', 'STRING'
 )
 
 class Token:
@@ -8,6 +8,8 @@ class Token:
     Represents a single token in the input.
     Each token has a type and a value.
     """
+    __slots__ = ('type', 'value')
+
     def __init__(self, type, value):
         self.type = type
         self.value = value
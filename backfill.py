@@ -0,0 +1,169 @@
+import mmap
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from database import SQLiteDataSink
+from django_database import AssetRegistry, expression_map
+from metrics import PipelineMetrics
+from records import RecordDecoder
+from regex_cache import pattern_guard
+
+# Seconds between two progress reports
+REPORT_INTERVAL = 1.0
+
+
+class BackfillError(Exception):
+    """Raised when a backfill worker exits with an error, the outputs of its range may be incomplete."""
+    pass
+
+
+def split_ranges(path, parts):
+    """
+    Splits the file into at most `parts` byte ranges of about the same size.
+    Every range but the last ends just after a newline, so no line is split between two ranges.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        boundaries = [0]
+        for part in range(1, parts):
+            newline = data.find(b'\n', max(size * part // parts, boundaries[-1]))
+            if newline == -1:
+                break
+            boundaries.append(newline + 1)
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def iter_batches(data, start, end, batch_size):
+    """
+    Yields (bytes consumed, records) for the lines of data[start:end], batch_size lines at a time.
+    Only the lines of the current batch are copied out of the mapped file.
+    """
+    pos = start
+    while pos < end:
+        batch_start = pos
+        records = []
+        while pos < end and len(records) < batch_size:
+            newline = data.find(b'\n', pos, end)
+            line_end = end if newline == -1 else newline
+            line = data[pos:line_end].strip()
+            if line:
+                records.append(line.decode("utf-8", errors="replace"))
+            pos = line_end + 1
+        yield min(pos, end) - batch_start, records
+
+
+def backfill_worker(path, start, end, progress, options):
+    """
+    Runs in a worker process: memory-maps the file itself and processes the lines of its byte
+    range, writing the outputs to the output database with its own connection. Sends
+    (bytes, records, errors) to the progress queue after every batch.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent process stops the workers
+    from Main import DataProcessor, expression_cache  # Imported here, Main imports this module
+
+    expression_cache.set_backend(options["backend"])
+    pattern_guard.timeout = options["regex_timeout"]
+    if options["expressions_db"] is not None:
+        expression_map.db_name = options["expressions_db"]
+    asset_registry = AssetRegistry(expression_map.db_name, timeout=60.0)
+    metrics = PipelineMetrics()
+    # Workers write concurrently, a batch waits for the others to commit theirs
+    data_sink = SQLiteDataSink(options["db_name"], batch_size=options["sink_batch_size"], wal=True,
+                               synchronous=options["synchronous"], timeout=60.0)
+    processor = DataProcessor(data_sink, batch_mode=options["batch_mode"], metrics=metrics,
+                              decoder=RecordDecoder(options["json_decoder"]), echo=False,
+                              asset_registry=asset_registry)
+    try:
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for consumed, records in iter_batches(data, start, end, options["read_batch_size"]):
+                failed = metrics.records_failed
+                processor.process_records(records)
+                progress.put((consumed, len(records), metrics.records_failed - failed))
+    finally:
+        data_sink.close()
+        expression_map.close()
+        asset_registry.close()
+        pattern_guard.close()
+
+
+def format_report(done_bytes, total_bytes, records, errors, elapsed):
+    rate = records / elapsed if elapsed > 0 else 0.0
+    throughput = done_bytes / elapsed / 1e6 if elapsed > 0 else 0.0
+    percent = 100.0 * done_bytes / total_bytes if total_bytes else 100.0
+    eta = (total_bytes - done_bytes) / (done_bytes / elapsed) if done_bytes and elapsed > 0 else 0.0
+    return (f"{percent:5.1f}% {records} records ({errors} errors) in {elapsed:.1f}s, "
+            f"{rate:.0f} records/s, {throughput:.1f} MB/s, ETA {eta:.0f}s")
+
+
+def run_backfill(path, workers=None, db_name="processed_data.db", batch_mode=False, backend='interpreter',
+                 regex_timeout=0.1, json_decoder='auto', sink_batch_size=5000, synchronous='NORMAL',
+                 read_batch_size=10000, expressions_db=None, report=print):
+    """
+    Processes the whole file with one worker process per byte range and returns a summary
+    dictionary. Progress is reported every REPORT_INTERVAL seconds. Output messages are not
+    printed, errors are.
+    Outputs of the same asset from different ranges may be written out of order.
+    Raises BackfillError if a worker fails. Outputs are idempotent, so the backfill can be run again.
+    """
+    workers = workers or os.cpu_count() or 1
+    total_bytes = os.path.getsize(path)
+    ranges = split_ranges(path, workers)
+    options = {
+        "db_name": db_name, "batch_mode": batch_mode, "backend": backend, "regex_timeout": regex_timeout,
+        "json_decoder": json_decoder, "sink_batch_size": sink_batch_size, "synchronous": synchronous,
+        "read_batch_size": read_batch_size, "expressions_db": expressions_db,
+    }
+
+    # Creates the table in WAL mode before the workers start, otherwise they all switch the
+    # database to WAL at once and one of them can fail with "database is locked"
+    SQLiteDataSink(db_name, wal=True, synchronous=synchronous).close()
+    context = multiprocessing.get_context("spawn")
+    progress = context.Queue()
+    processes = [context.Process(target=backfill_worker, args=(path, start, end, progress, options), daemon=True)
+                 for start, end in ranges]
+    started = time.monotonic()
+    for process in processes:
+        process.start()
+
+    done_bytes = records = errors = 0
+    next_report = started + REPORT_INTERVAL
+    try:
+        while True:
+            running = any(process.is_alive() for process in processes)
+            try:
+                consumed, count, failed = progress.get(timeout=0.1 if running else 0)
+                done_bytes += consumed
+                records += count
+                errors += failed
+            except queue.Empty:
+                if not running:
+                    break
+            if time.monotonic() >= next_report:
+                report("Backfill " + format_report(done_bytes, total_bytes, records, errors,
+                                                   time.monotonic() - started))
+                next_report += REPORT_INTERVAL
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+            process.join()
+
+    elapsed = time.monotonic() - started
+    failed = [f"bytes {start}-{end} (exit code {process.exitcode})"
+              for process, (start, end) in zip(processes, ranges) if process.exitcode != 0]
+    if failed:
+        raise BackfillError(f"Backfill workers failed for {', '.join(failed)}, "
+                            f"{done_bytes} of {total_bytes} bytes were processed")
+    report("Backfill finished: " + format_report(done_bytes, total_bytes, records, errors, elapsed))
+    return {
+        "bytes": done_bytes,
+        "records": records,
+        "errors": errors,
+        "seconds": elapsed,
+    }
@@ -0,0 +1,45 @@
+"""
+Compares the per evaluation latency of the Interpreter and VirtualMachine backends.
+
+Run from the repository root:
+    python -m benchmarks.bench_backends
+"""
+import timeit
+from compiler import BACKENDS, CompiledExpression
+
+
+def make_expression(terms):
+    """Builds an arithmetic expression made of `terms` copies of the config.txt equation."""
+    return "+".join(["ATTR+50*(ATTR/10)"] * terms)
+
+
+EXPRESSIONS = {
+    "small (7 nodes)": make_expression(1),
+    "medium (79 nodes)": make_expression(10),
+    "large (799 nodes)": make_expression(100),
+    "deep (7999 nodes)": make_expression(1000),
+}
+
+
+def time_evaluation(compiled, value=12.5):
+    """Returns the best per evaluation time in microseconds."""
+    timer = timeit.Timer(lambda: compiled.evaluate(value))
+    loops, _ = timer.autorange()
+    return min(timer.repeat(5, loops)) / loops * 1e6
+
+
+def main():
+    print(f"{'expression':<20}" + "".join(f"{backend:>16}" for backend in BACKENDS))
+    for name, expression in EXPRESSIONS.items():
+        row = f"{name:<20}"
+        for backend in BACKENDS:
+            compiled = CompiledExpression(expression, backend=backend)
+            try:
+                row += f"{time_evaluation(compiled):>13.2f} us"
+            except RecursionError:
+                row += f"{'recursion limit':>16}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Microbenchmark suite for the engine: Lexer, Parser, Interpreter, process_message,
+DataProcessor and SQLiteDataSink, over a range of expression sizes and batch sizes.
+
+Run from the repository root:
+    python -m benchmarks.run                      # compare against benchmarks/baseline.json
+    python -m benchmarks.run --output out.json    # also write the results as JSON
+    python -m benchmarks.run --save-baseline      # record the current numbers as the baseline
+
+The exit status is 1 when a benchmark is slower than its baseline by more than --tolerance.
+Results are compared after dividing by a calibration workload timed in the same run, so the
+baseline stays meaningful on a faster or slower (or busier) machine.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+from unittest import mock
+
+from compiler import ExpressionCache
+from database import SQLiteDataSink
+from interpreter import *
+from Main import DataProcessor, process_message
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Expressions built from the config.txt equation, from 7 to 799 AST nodes
+EXPRESSION_SIZES = {"small": 1, "medium": 10, "large": 100}
+BATCH_SIZES = [1, 100, 1000]
+
+
+def make_expression(terms):
+    return "+".join(["ATTR+50*(ATTR/10)"] * terms)
+
+
+def make_records(count):
+    """Builds input records for three assets, one of them with a Regex KPI."""
+    records = []
+    for index in range(count):
+        asset_id = str(123 + index % 3)
+        value = "dog_bark" if asset_id == "124" else str(index % 50)
+        records.append(json.dumps({"asset_id": asset_id, "attribute_id": "101",
+                                   "timestamp": f"2022-07-31T23:28:{index % 60:02d}Z[UTC]", "value": value}))
+    return records
+
+
+EXPRESSIONS_BY_ASSET = {"123": "ATTR+50*(ATTR/10)", "124": 'Regex(ATTR, "^dog")', "125": "ATTR*4"}
+
+
+def time_per_op(function, ops=1):
+    """Returns the best time of one call divided by ops, in microseconds."""
+    timer = timeit.Timer(function)
+    loops, _ = timer.autorange()
+    return min(timer.repeat(5, loops)) / loops / ops * 1e6
+
+
+def calibration_workload():
+    """Fixed pure Python work used to measure the speed of the machine."""
+    total = 0
+    for index in range(1000):
+        total += index * 2 // 3
+    return total
+
+
+def tokenize(text):
+    lexer = Lexer(text)
+    while lexer.get_next_token() is not None:
+        pass
+
+
+def benchmark_expressions(results):
+    for size, terms in EXPRESSION_SIZES.items():
+        text = make_expression(terms)
+        tree = Parser(Lexer(text)).parse()
+        interpreter = Interpreter(None, 12.5)
+        message = make_records(1)[0]
+        results[f"lexer.tokenize[{size}]"] = time_per_op(lambda: tokenize(text))
+        results[f"parser.parse[{size}]"] = time_per_op(lambda: Parser(Lexer(text)).parse())
+        results[f"interpreter.visit[{size}]"] = time_per_op(lambda: interpreter.visit(tree))
+        cache = ExpressionCache()
+        results[f"process_message[{size}]"] = time_per_op(lambda: process_message(message, text, cache))
+
+
+def benchmark_batches(results):
+    for batch_size in BATCH_SIZES:
+        records = make_records(batch_size)
+        for batch_mode in (False, True):
+            processor = DataProcessor(mock.Mock(), batch_mode=batch_mode)
+            name = f"data_processor.{'batch' if batch_mode else 'records'}[{batch_size}]"
+            with mock.patch("Main.get_expression", EXPRESSIONS_BY_ASSET.get), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                results[name] = time_per_op(lambda: processor.process_records(records), batch_size)
+
+
+def benchmark_sink(results):
+    messages = [process_message(record, EXPRESSIONS_BY_ASSET[json.loads(record)["asset_id"]])
+                for record in make_records(100)]
+    for batch_size in (1, len(messages)):
+        name = "sqlite_sink.write_message" if batch_size == 1 else f"sqlite_sink.write_message[batch={batch_size}]"
+        with tempfile.TemporaryDirectory() as directory:
+            sink = SQLiteDataSink(os.path.join(directory, "bench.db"), batch_size=batch_size,
+                                  wal=batch_size > 1, synchronous="NORMAL" if batch_size > 1 else None)
+            try:
+                timestamps = itertools.count()
+
+                def write_batch():
+                    # A new timestamp per write, the sink drops and overwrites rows with the same key
+                    for message in messages:
+                        sink.write_message(dict(message, timestamp=next(timestamps)))
+                results[name] = time_per_op(write_batch, len(messages))
+            finally:
+                sink.close()
+
+
+def run_benchmarks():
+    """
+    Runs every benchmark and returns ({name: microseconds per operation}, calibration).
+    The calibration is timed between the groups and its fastest run is kept.
+    """
+    results = {}
+    calibrations = []
+    for benchmark in (benchmark_expressions, benchmark_batches, benchmark_sink):
+        calibrations.append(time_per_op(calibration_workload))
+        benchmark(results)
+    calibrations.append(time_per_op(calibration_workload))
+    return results, min(calibrations)
+
+
+def compare(results, calibration, baseline, baseline_calibration, tolerance):
+    """
+    Prints every result next to its baseline and returns the names of the regressions.
+    The ratio is computed on the results scaled by their calibration.
+    """
+    regressions = []
+    scale = baseline_calibration / calibration
+    print(f"Machine speed relative to the baseline: {scale:.2f}x")
+    print(f"{'benchmark':<36}{'us/op':>12}{'baseline':>12}{'ratio':>8}")
+    for name, value in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            print(f"{name:<36}{value:>12.2f}{'-':>12}{'-':>8}")
+            continue
+        ratio = value * scale / reference
+        flag = ""
+        if ratio > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<36}{value:>12.2f}{reference:>12.2f}{ratio:>8.2f}{flag}")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Runs the engine microbenchmarks.")
+    arg_parser.add_argument("--output", help="write the results to this JSON file")
+    arg_parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline JSON file to compare against")
+    arg_parser.add_argument("--tolerance", type=float, default=2.0,
+                            help="fail when a benchmark is slower than baseline * tolerance")
+    arg_parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    args = arg_parser.parse_args()
+
+    results, calibration = run_benchmarks()
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "unit": "microseconds per operation",
+        "calibration": calibration,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    baseline = {"results": {}, "calibration": calibration}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    regressions = compare(results, calibration, baseline["results"], baseline["calibration"], args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.tolerance}x: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
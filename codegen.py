@@ -0,0 +1,104 @@
+import math
+from AST import *
+from regex_cache import pattern_cache
+
+# Python operator and precedence for each operation type, all of them are left associative
+OPERATORS = {
+    'PLUS': ('+', 1),
+    'MINUS': ('-', 1),
+    'MUL': ('*', 2),
+    'DIV': ('/', 2)
+}
+ATOM = 3  # Precedence of literals, names and calls
+
+
+class CodegenError(Exception):
+    """Raised when an AST cannot be turned into Python source."""
+    pass
+
+
+def match_regex(match, value):
+    """Calls the match method of a compiled pattern, with the same result as Interpreter.visit_Regex."""
+    return 'True' if match(value) else 'False'
+
+
+class SourceGenerator:
+    """
+    Generates the source of a Python lambda taking ATTR from an AST.
+    Only the node types produced by the Parser are accepted and the source is built from a
+    fixed set of tokens: the ATTR parameter, the four operators, parentheses, numeric literals
+    and generated names. Compiled regex patterns and unusual constants never appear in the source,
+    they are passed to the function through its namespace, so expression text cannot inject code.
+    """
+    def __init__(self):
+        self.namespace = {'__builtins__': {}, '_regex': match_regex}
+
+    def add_constant(self, value):
+        """Stores a value in the namespace and returns the generated name referring to it."""
+        name = f'_c{len(self.namespace)}'
+        self.namespace[name] = value
+        return name
+
+    def literal(self, value):
+        """Returns the source of a numeric constant."""
+        if type(value) is int and abs(value) < 10 ** 18:
+            return repr(value) if value >= 0 else f'({value!r})'
+        if type(value) is float and math.isfinite(value) and math.copysign(1.0, value) > 0:
+            return repr(value)
+        if type(value) in (int, float):
+            return self.add_constant(value)
+        raise CodegenError(f"Unsupported constant {value!r}")
+
+    def generate(self, tree):
+        """
+        Returns the source of the lambda for the tree.
+        The tree is walked with an explicit stack and parentheses are only emitted where
+        Python precedence requires them, keeping left-deep chains flat.
+        """
+        results = []  # (source, precedence) of the generated subexpressions
+        stack = [(tree, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if type(node) is BinOp:
+                if node.op.type not in OPERATORS:
+                    raise CodegenError(f"Unsupported operation: {node.op.type}")
+                operator, precedence = OPERATORS[node.op.type]
+                if not children_done:
+                    stack.append((node, True))
+                    stack.append((node.right, False))
+                    stack.append((node.left, False))
+                    continue
+                right, right_precedence = results.pop()
+                left, left_precedence = results.pop()
+                if left_precedence < precedence:
+                    left = f'({left})'
+                if right_precedence <= precedence:  # Keeps a-(b-c) and a*(b*c) grouped as parsed
+                    right = f'({right})'
+                results.append((f'{left}{operator}{right}', precedence))
+            elif type(node) is Num:
+                results.append((self.literal(node.value), ATOM))
+            elif type(node) is Attr:
+                results.append(('ATTR', ATOM))
+            elif type(node) is Regex:
+                if not isinstance(node.pattern.value, str):
+                    raise CodegenError("Regex pattern must be a string")
+                match = pattern_cache.get(node.pattern.value).match
+                results.append((f'_regex({self.add_constant(match)}, ATTR)', ATOM))
+            else:
+                raise CodegenError(f"Unsupported node {type(node).__name__}")
+        source, _ = results.pop()
+        return f'lambda ATTR: {source}'
+
+
+def generate_function(tree):
+    """
+    Compiles the tree into a Python function taking ATTR and returning the result.
+    Raises CodegenError if the tree is not supported or too deep for the Python compiler.
+    """
+    generator = SourceGenerator()
+    source = generator.generate(tree)
+    try:
+        code = compile(source, '<kpi expression>', 'eval')
+    except (RecursionError, MemoryError, SyntaxError) as e:
+        raise CodegenError(f"Expression cannot be compiled: {e}")
+    return eval(code, generator.namespace)
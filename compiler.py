@@ -0,0 +1,132 @@
+import threading
+from collections import OrderedDict
+from interpreter import *
+from optimizer import Optimizer
+from vm import VirtualMachine
+from codegen import CodegenError, generate_function
+
+# Evaluation backends a CompiledExpression can use
+BACKENDS = ('interpreter', 'vm', 'codegen')
+
+
+class CompiledExpression:
+    """
+    A KPI expression that has been lexed and parsed once.
+    The resulting AST does not depend on the attribute value, so it can be evaluated
+    for any number of records by passing ATTR at evaluation time.
+    Unless optimize is False the tree goes through the Optimizer after parsing.
+    backend selects how the tree is evaluated: walked by the Interpreter, compiled to
+    instructions for the VirtualMachine or generated as a Python function ('codegen').
+    Trees too deep for the Python compiler fall back from 'codegen' to 'vm'.
+    """
+    def __init__(self, expression, optimize=True, backend='interpreter'):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {', '.join(BACKENDS)}")
+        self.expression = expression
+        self.backend = backend
+        self.is_regex = "Regex" in expression  # Same rule process_message uses to pick the mode
+        self.tree = Parser(Lexer(expression)).parse()
+        if self.tree is None:  # Ensuring tree is valid
+            raise Exception("Failed to parse equation: Invalid AST")
+
+        self.nodes_removed = 0
+        if optimize:
+            optimizer = Optimizer(numeric_attr=not self.is_regex)  # ATTR is a string in regex mode
+            try:
+                self.tree = optimizer.optimize(self.tree)
+                self.nodes_removed = optimizer.nodes_removed
+            except RecursionError:  # Too deep for the optimizer, evaluate it as parsed
+                pass
+
+        self._evaluate = self.build_evaluator()
+
+    def build_evaluator(self):
+        """Returns the callable evaluating the tree with the selected backend."""
+        if self.backend == 'codegen':
+            try:
+                return generate_function(self.tree)
+            except CodegenError:
+                self.backend = 'vm'
+        if self.backend == 'vm':
+            return VirtualMachine(self.tree).evaluate
+        return self.interpret
+
+    def interpret(self, attr_value):
+        """Evaluates the tree with the Interpreter."""
+        return Interpreter(None, attr_value).visit(self.tree)
+
+    def evaluate(self, attr_value):
+        """Evaluates the expression with ATTR bound to attr_value."""
+        return self._evaluate(attr_value)
+
+
+class ExpressionCache:
+    """
+    LRU cache of compiled expressions keyed by the expression text.
+    Keeps hit/miss counters so the cache size can be tuned.
+    """
+    def __init__(self, maxsize=1024, optimize=True, backend='interpreter'):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {', '.join(BACKENDS)}")
+        self.maxsize = maxsize
+        self.optimize = optimize
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, expression):
+        """
+        Returns the compiled form of the expression, compiling it on a miss.
+        Expressions that fail to compile are not cached, the error is raised to the caller.
+        """
+        with self._lock:
+            compiled = self._entries.get(expression)
+            if compiled is not None:
+                self._entries.move_to_end(expression)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        compiled = CompiledExpression(expression, optimize=self.optimize, backend=self.backend)
+
+        with self._lock:
+            self._entries[expression] = compiled
+            self._entries.move_to_end(expression)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)  # Evict the least recently used expression
+        return compiled
+
+    def set_backend(self, backend):
+        """Switches the backend used for new compilations and drops the cached expressions."""
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {', '.join(BACKENDS)}")
+        self.backend = backend
+        self.clear()
+
+    def clear(self):
+        """Drops every cached expression and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns the cache counters as a dictionary."""
+        with self._lock:
+            nodes_removed = sum(compiled.nodes_removed for compiled in self._entries.values())
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "nodes_removed": nodes_removed,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, expression):
+        return expression in self._entries
@@ -1,10 +1,59 @@
+import os
 import sqlite3
+import time
+from collections import OrderedDict
+
+# Values of PRAGMA synchronous, from fastest to safest
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
 
 class SQLiteDataSink:
-    def __init__(self, db_name):
+    """
+    Writes output messages to the processed_data table.
+    Messages are buffered and inserted with one executemany per transaction, when batch_size
+    messages are pending or flush_interval seconds have passed since the oldest pending one
+    (checked on every write and by flush_if_due). The default batch_size of 1 commits every message.
+    timeout is how long a write waits for another connection to release its lock on the database.
+
+    With a checkpoint_source (the input file path), the reader position passed to checkpoint() is
+    stored in the reader_checkpoint table in the same transaction as the messages it covers, so
+    a restart resumes after the last committed output. Messages are then only flushed by
+    checkpoint(), flush_if_due and close, never in the middle of a batch, and the messages written
+    after the last checkpoint() are left pending by a flush and dropped by close: the input they
+    came from is read again after a restart. The position is stored
+    at most every checkpoint_interval seconds (0 for every flush): a longer interval means fewer
+    writes but outputs committed since the last checkpoint are written again after a restart.
+
+    Rows are unique per (asset_id, attribute_id, timestamp): writing a key again updates its value.
+    The last recent_keys keys written are remembered with their value, and a message identical
+    to one of them, a replay, is dropped before it reaches SQLite.
+    """
+    def __init__(self, db_name, batch_size=1, flush_interval=1.0, wal=False, synchronous=None, timeout=5.0,
+                 checkpoint_source=None, checkpoint_interval=0.0, recent_keys=100000):
+        if synchronous is not None and synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode '{synchronous}', expected one of {', '.join(SYNCHRONOUS_MODES)}")
         self.db_name = db_name
-        self.connection = sqlite3.connect(self.db_name)
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.connection = sqlite3.connect(self.db_name, timeout=timeout)
         self.cursor = self.connection.cursor()
+        if wal:  # Readers do not block the writer and a commit appends to the log instead of rewriting pages
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+        if synchronous is not None:
+            self.cursor.execute(f"PRAGMA synchronous={synchronous.upper()}")
+        self.pending = []
+        self.covered = 0  # Pending messages covered by the position of the last checkpoint()
+        self.oldest_pending = None  # When the oldest unsaved message or position was written
+        self.flushes = 0
+        self.rows_written = 0
+        self.checkpoint_source = checkpoint_source
+        self.checkpoint_interval = checkpoint_interval
+        self.position = None  # (inode, offset) of the input covered by the messages written so far
+        self.saved_position = None
+        self.last_checkpoint = None
+        self.checkpoints = 0
+        self.recent_keys = recent_keys
+        self.recent = OrderedDict()  # (asset_id, attribute_id, timestamp) -> value, least recent first
+        self.duplicates_dropped = 0
         self.initialize_table()
 
     def initialize_table(self):
@@ -16,14 +65,150 @@ class SQLiteDataSink:
                 value TEXT
             )
         """)
+        index = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'processed_data_key'").fetchone()
+        if index is None:
+            # Tables written before the index keep the last row written of each key
+            self.cursor.execute("""
+                DELETE FROM processed_data WHERE rowid NOT IN (
+                    SELECT MAX(rowid) FROM processed_data GROUP BY asset_id, attribute_id, timestamp
+                )
+            """)
+            self.cursor.execute("""
+                CREATE UNIQUE INDEX processed_data_key ON processed_data (asset_id, attribute_id, timestamp)
+            """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reader_checkpoint (
+                source TEXT PRIMARY KEY,
+                inode INTEGER,
+                byte_offset INTEGER,
+                updated REAL
+            )
+        """)
         self.connection.commit()
 
     def write_message(self, message):
-        self.cursor.execute("""
-            INSERT INTO processed_data (asset_id, attribute_id, timestamp, value)
-            VALUES (?, ?, ?, ?)
-        """, (message["asset_id"], message["attribute_id"], message["timestamp"], message["value"]))
-        self.connection.commit()
+        key = (message["asset_id"], message["attribute_id"], message["timestamp"])
+        if self.is_replay(key, message["value"]):
+            self.duplicates_dropped += 1
+            return
+        if self.oldest_pending is None:
+            self.oldest_pending = time.monotonic()
+        self.pending.append((*key, message["value"]))
+        if self.checkpoint_source is None:  # Otherwise flushed by checkpoint(), at the end of the batch
+            self.flush_if_full()
+
+    def is_replay(self, key, value):
+        """Returns True if the key was recently written with the same value, and remembers it otherwise."""
+        if not self.recent_keys:
+            return False
+        if key in self.recent and self.recent[key] == value:
+            self.recent.move_to_end(key)
+            return True
+        self.recent[key] = value
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.recent_keys:
+            self.recent.popitem(last=False)
+        return False
+
+    def checkpoint(self, position):
+        """
+        Records that the messages written so far cover the input up to position, the
+        (inode, offset) pair of FileReader.position(), then flushes if the messages are due.
+        """
+        if self.checkpoint_source is not None:
+            self.covered = len(self.pending)
+            if position is not None and position != self.position:
+                self.position = position
+                if self.oldest_pending is None:
+                    self.oldest_pending = time.monotonic()
+        self.flush_if_full()
+
+    def flush_if_full(self):
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flushes the pending messages if the oldest one has waited flush_interval seconds."""
+        if self.oldest_pending is not None and time.monotonic() - self.oldest_pending >= self.flush_interval:
+            self.flush()
+
+    def flush(self, force_checkpoint=False):
+        """
+        Inserts the pending messages, and the reader position if a checkpoint is due, in one transaction.
+        With a checkpoint_source only the messages covered by the last checkpoint() are inserted.
+        On error the transaction is rolled back and the messages stay pending for the next flush.
+        """
+        rows = self.pending if self.checkpoint_source is None else self.pending[:self.covered]
+        save_position = (self.checkpoint_source is not None and self.position != self.saved_position and (
+            force_checkpoint or self.last_checkpoint is None
+            or time.monotonic() - self.last_checkpoint >= self.checkpoint_interval))
+        if not rows and not save_position:
+            self.oldest_pending = self._unsaved_since()
+            return
+        with self.connection:  # Commits, or rolls back if an exception is raised
+            self.cursor.executemany("""
+                INSERT INTO processed_data (asset_id, attribute_id, timestamp, value)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (asset_id, attribute_id, timestamp) DO UPDATE SET value = excluded.value
+                WHERE value IS NOT excluded.value
+            """, rows)
+            if save_position:
+                self.cursor.execute("""
+                    INSERT OR REPLACE INTO reader_checkpoint (source, inode, byte_offset, updated)
+                    VALUES (?, ?, ?, ?)
+                """, (self.checkpoint_source, *self.position, time.time()))
+        if save_position:
+            self.saved_position = self.position
+            self.last_checkpoint = time.monotonic()
+            self.checkpoints += 1
+        self.flushes += 1
+        self.rows_written += len(rows)
+        self.pending = self.pending[len(rows):]
+        self.covered = 0
+        self.oldest_pending = time.monotonic() if self.pending else self._unsaved_since()
+
+    def _unsaved_since(self):
+        """A position not stored yet makes the sink due again after flush_interval."""
+        return None if self.position == self.saved_position else time.monotonic()
+
+    def stats(self):
+        """Returns the sink counters as a dictionary."""
+        return {
+            "pending": len(self.pending),
+            "batch_size": self.batch_size,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "checkpoints": self.checkpoints,
+            "duplicates_dropped": self.duplicates_dropped,
+        }
 
     def close(self):
-        self.connection.close()
+        """
+        Flushes the pending messages and closes the connection. With a checkpoint_source the
+        messages not covered by a checkpoint() are dropped rather than committed with a position
+        that does not include them.
+        """
+        try:
+            if self.checkpoint_source is not None:
+                del self.pending[self.covered:]
+            self.flush(force_checkpoint=True)
+        finally:
+            self.connection.close()
+
+
+def read_checkpoint(db_name, source):
+    """Returns the (inode, offset) stored for the input file by an SQLiteDataSink, or None."""
+    if not os.path.exists(db_name):
+        return None
+    connection = sqlite3.connect(db_name)
+    try:
+        row = connection.execute("SELECT inode, byte_offset FROM reader_checkpoint WHERE source = ?",
+                                  (source,)).fetchone()
+    except sqlite3.OperationalError:  # Written by a version without checkpoints
+        return None
+    finally:
+        connection.close()
+    return tuple(row) if row else None
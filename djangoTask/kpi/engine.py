@@ -0,0 +1,61 @@
+"""
+Gives the kpi app access to the expression engine, whose modules live in the repository root.
+"""
+import math
+import sys
+from django.conf import settings
+
+ENGINE_DIR = str(settings.BASE_DIR.parent)
+if ENGINE_DIR not in sys.path:
+    sys.path.append(ENGINE_DIR)
+
+from AST import regex_patterns
+from lexer import Lexer
+from parser import Parser
+from regex_guard import find_unsafe_constructs
+from compiler import ExpressionCache
+from vectorized import evaluate_batch, is_vectorizable
+import vectorized
+
+# Compiled expressions shared by every request of this process, an expression is parsed once
+expression_cache = ExpressionCache(backend='codegen')
+
+
+def evaluate_values(expression, values):
+    """
+    Evaluates the expression for each value the way the engine evaluates records: ATTR is the
+    value as a float in arithmetic expressions and the value as given in Regex expressions.
+    Arithmetic expressions are evaluated over all the values at once with NumPy when installed.
+    Returns one (result, error message) pair per value. Raises if the expression does not compile.
+    """
+    compiled = expression_cache.get(expression.strip())
+    results = [None] * len(values)
+    attr_values = []
+    indexes = []
+    for index, value in enumerate(values):
+        try:
+            attr_values.append(value if compiled.is_regex else float(value))
+            indexes.append(index)
+        except (TypeError, ValueError):
+            results[index] = (None, f"Non-numeric value '{value}' cannot be used in arithmetic equations")
+
+    if not compiled.is_regex and vectorized.available and is_vectorizable(compiled.tree):
+        evaluated = evaluate_batch(compiled.tree, attr_values)
+    else:
+        evaluated = [evaluate(compiled, attr_value) for attr_value in attr_values]
+    for index, (result, error) in zip(indexes, evaluated):
+        if error is not None:
+            results[index] = (None, str(error))
+        elif isinstance(result, float) and not math.isfinite(result):  # Not representable in JSON
+            results[index] = (None, f"Result {result} is not a finite number")
+        else:
+            results[index] = (result, None)
+    return results
+
+
+def evaluate(compiled, attr_value):
+    """Returns the (result, error) pair of one evaluation."""
+    try:
+        return compiled.evaluate(attr_value), None
+    except Exception as e:
+        return None, e
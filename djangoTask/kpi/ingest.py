@@ -0,0 +1,164 @@
+"""
+HTTP ingestion of input records: an ASGI middleware accepts newline-delimited JSON batches
+and hands them to the engine running in a background thread of the same process.
+"""
+import json
+import queue
+import threading
+
+from . import engine  # Makes the engine modules importable
+from database import SQLiteDataSink
+from django_database import AssetRegistry, expression_map
+from Main import DataProcessor
+
+
+class IngestionEngine:
+    """
+    Processes the batches of input lines submitted over HTTP in one background thread, with the
+    DataProcessor and SQLiteDataSink the engine uses for data.txt.
+    At most queue_size batches wait in the queue: submit() returns False rather than blocking
+    when it is full, so producers are told to retry while the engine is saturated.
+    """
+    def __init__(self, db_name, expressions_db, queue_size=64, sink_batch_size=500, flush_interval=1.0):
+        self.db_name = db_name
+        self.expressions_db = expressions_db
+        self.queue = queue.Queue(queue_size)
+        self.sink_batch_size = sink_batch_size
+        self.flush_interval = flush_interval
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches_accepted = 0
+        self.batches_rejected = 0
+        self.records_accepted = 0
+
+    def start(self):
+        """Starts the engine thread, if it is not running."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="ingestion", daemon=True)
+                self.thread.start()
+
+    def submit(self, lines):
+        """Queues a batch of input lines, returns False if the queue is full."""
+        self.start()
+        try:
+            self.queue.put_nowait(lines)
+        except queue.Full:
+            self.batches_rejected += 1
+            return False
+        self.batches_accepted += 1
+        self.records_accepted += len(lines)
+        return True
+
+    def run(self):
+        expression_map.db_name = str(self.expressions_db)
+        data_sink = SQLiteDataSink(self.db_name, batch_size=self.sink_batch_size, flush_interval=self.flush_interval,
+                                   wal=True, synchronous='NORMAL')
+        asset_registry = AssetRegistry(str(self.expressions_db))
+        processor = DataProcessor(data_sink, echo=False, asset_registry=asset_registry)
+        try:
+            while True:
+                try:
+                    lines = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    data_sink.flush_if_due()
+                    continue
+                try:
+                    if lines is None:
+                        break
+                    processor.process_records(lines)
+                    data_sink.flush_if_due()
+                finally:
+                    self.queue.task_done()
+        finally:
+            data_sink.close()  # Flushes the pending messages
+            asset_registry.close()
+            expression_map.close()
+
+    def stop(self):
+        """Processes the queued batches, then stops the engine thread."""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        """Returns the ingestion counters as a dictionary."""
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "batches_accepted": self.batches_accepted,
+            "batches_rejected": self.batches_rejected,
+            "records_accepted": self.records_accepted,
+        }
+
+
+class IngestionMiddleware:
+    """
+    ASGI middleware answering POST requests to path with a body of newline-delimited JSON
+    records, one per line as in data.txt. Each batch is acknowledged with 202 once queued for the
+    engine, or refused with 429 and Retry-After while the queue is full. Other requests go to app.
+    Starts the engine with the ASGI lifespan and processes the queued batches on shutdown.
+    """
+    def __init__(self, app, engine, path='/api/kpi/ingest/', max_body_size=16 << 20, retry_after=1):
+        self.app = app
+        self.engine = engine
+        self.path = path
+        self.max_body_size = max_body_size
+        self.retry_after = retry_after
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == self.path:
+            await self.ingest(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.engine.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.engine.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def ingest(self, scope, receive, send):
+        if scope['method'] != 'POST':
+            await self.respond(send, 405, {'detail': 'Method not allowed.'}, [(b'allow', b'POST')])
+            return
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if len(body) > self.max_body_size:
+                await self.respond(send, 413, {'detail': f'Batches are limited to {self.max_body_size} bytes.'})
+                return
+            if not message.get('more_body', False):
+                break
+
+        lines = [line for line in body.decode('utf-8', errors='replace').splitlines() if line.strip()]
+        if not lines:
+            await self.respond(send, 400, {'detail': 'Expected newline-delimited JSON records.'})
+        elif self.engine.submit(lines):
+            await self.respond(send, 202, {'accepted': len(lines)})
+        else:
+            await self.respond(send, 429, {'detail': 'The engine is saturated, retry later.'},
+                               [(b'retry-after', str(self.retry_after).encode())])
+
+    @staticmethod
+    async def respond(send, status, data, headers=()):
+        body = json.dumps(data).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                        *headers],
+        })
+        await send({'type': 'http.response.body', 'body': body})
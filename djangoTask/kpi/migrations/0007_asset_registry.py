@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:30
+
+import json
+
+import django.db.models.functions.datetime
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_assets(apps, schema_editor):
+    """
+    Registers the assets already linked to a KPI and those of the input file, read once here.
+    From then on the engine registers new assets as their records arrive.
+    """
+    Asset = apps.get_model('kpi', 'Asset')
+    AssetKPI = apps.get_model('kpi', 'AssetKPI')
+    asset_ids = set(AssetKPI.objects.values_list('asset_id', flat=True))
+    try:
+        with open(settings.ENGINE_INPUT_FILE) as file:
+            for line in file:
+                try:
+                    asset_ids.add(str(json.loads(line)['asset_id']))
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except FileNotFoundError:
+        pass
+    Asset.objects.bulk_create([Asset(asset_id=asset_id) for asset_id in asset_ids],
+                              batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0006_alter_assetkpi_asset_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Asset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('asset_id', models.CharField(max_length=255, unique=True)),
+                ('first_seen', models.DateTimeField(db_default=django.db.models.functions.datetime.Now())),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='assetkpi',
+            name='asset_id',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.RunPython(seed_assets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0007_asset_registry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kpi',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -1,35 +1,7 @@
 from rest_framework import serializers
-from .models import KPI, AssetKPI
-import json
-import sqlite3
-
-# Function to fetch distinct asset_ids from processed_data
-# def get_asset_ids():
-#     conn = sqlite3.connect('../processed_data.db')
-#     cursor = conn.cursor()
-#
-#     cursor.execute("SELECT DISTINCT asset_id FROM processed_data")
-#     asset_ids = [row[0] for row in cursor.fetchall()]
-#
-#     conn.close()
-#
-#     return [(asset_id, asset_id) for asset_id in asset_ids]
-
-def get_asset_ids():
-    """
-    Reads unique asset IDs from a text file containing JSON-like data.
-
-    Returns:
-        list: A list of tuples where each tuple contains an asset ID twice.
-    """
-    file_path = "data.txt"
-
-    with open(file_path, 'r') as file:
-        # Parse each line as JSON and collect unique asset_ids
-        asset_ids = set(json.loads(line.strip())['asset_id'] for line in file if line.strip())
-
-    # Return asset IDs in the desired format
-    return [(asset_id, asset_id) for asset_id in asset_ids]
+from .models import KPI, Asset, AssetKPI
+from .engine import Lexer, Parser, find_unsafe_constructs, regex_patterns
+import re
 
 
 class KPISerializer(serializers.ModelSerializer):
@@ -37,9 +9,54 @@ class KPISerializer(serializers.ModelSerializer):
         model = KPI
         fields = ['id', 'name', 'expression', 'description']
 
+    def __init__(self, *args, fields=None, **kwargs):
+        """fields limits the serialized fields to the given names."""
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    def validate_expression(self, value):
+        """
+        Rejects expressions the engine cannot parse and Regex patterns prone to
+        catastrophic backtracking, like nested quantifiers in (a+)+.
+        """
+        try:
+            tree = Parser(Lexer(value)).parse()
+        except Exception as e:
+            raise serializers.ValidationError(f"Invalid expression: {e}")
+
+        for pattern in regex_patterns(tree):
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise serializers.ValidationError(f"Invalid regex pattern {pattern!r}: {e}")
+            problems = find_unsafe_constructs(pattern)
+            if problems:
+                raise serializers.ValidationError(
+                    f"Regex pattern {pattern!r} can take super-linear time: {'; '.join(problems)}")
+        return value
+
 
 class AssetKPISerializer(serializers.ModelSerializer):
-    asset_id = serializers.ChoiceField(choices=get_asset_ids()) 
     class Meta:
         model = AssetKPI
         fields = ['id', 'asset_id', 'kpi']
+
+    def validate_asset_id(self, value):
+        """Only assets registered by the engine can be linked."""
+        if not Asset.objects.filter(asset_id=value).exists():
+            raise serializers.ValidationError(f'"{value}" is not a known asset.')
+        return value
+
+
+class BulkLinkItemSerializer(serializers.Serializer):
+    """One (asset_id, kpi) pair of a bulk link request, checked against the database in bulk."""
+    asset_id = serializers.CharField(max_length=255)
+    kpi = serializers.IntegerField()
+
+
+class BulkLinkRuleSerializer(serializers.Serializer):
+    """Links every registered asset whose asset_id matches the glob pattern (like '12*') to the KPI."""
+    asset_pattern = serializers.CharField(max_length=255)
+    kpi = serializers.IntegerField()
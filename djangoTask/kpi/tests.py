@@ -1,10 +1,18 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+from unittest import mock
+from django.test import SimpleTestCase, TestCase, override_settings
 
 # Create your tests here.
 from rest_framework import status
 from rest_framework.test import APIClient
-from .models import KPI, AssetKPI
-from django.db import IntegrityError
+from .engine import expression_cache
+from .ingest import IngestionEngine, IngestionMiddleware
+from .models import KPI, Asset, AssetKPI
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 import sqlite3
 
 class KPIModelTest(TestCase):
@@ -65,3 +73,236 @@ class APIEndpointsTest(TestCase):
         response = self.client.post('/api/kpi/kpis/', new_kpi_data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(response.data['name'], new_kpi_data['name'])
+
+    def test_kpi_create_rejects_invalid_expression(self):
+        """Expressions the engine cannot parse are rejected."""
+        response = self.client.post('/api/kpi/kpis/', {'name': 'Bad', 'expression': 'ATTR * foo'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('expression', response.data)
+
+    def test_kpi_create_rejects_unsafe_regex(self):
+        """Regex patterns with nested quantifiers or repeated overlapping alternatives are rejected."""
+        for pattern in ('(a+)+$', '(a|aa)+$', '(a|a)*'):
+            response = self.client.post('/api/kpi/kpis/', {'name': 'Slow', 'expression': f'Regex(ATTR, "{pattern}")'},
+                                        format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, pattern)
+
+        response = self.client.post('/api/kpi/kpis/', {'name': 'Dog', 'expression': 'Regex(ATTR, "^dog")'},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_kpi_list_pagination_and_fields(self):
+        """The list is paginated with a cursor and serializes only the fields asked for."""
+        for index in range(5):
+            KPI.objects.create(name=f'KPI {index}', expression='ATTR * 2')
+        response = self.client.get('/api/kpi/kpis/', {'page_size': 2, 'fields': 'id,name'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [{'id': kpi.id, 'name': kpi.name}
+                                                    for kpi in KPI.objects.order_by('id')[:2]])
+        names = [kpi['name'] for kpi in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            names += [kpi['name'] for kpi in response.data['results']]
+        self.assertEqual(names, [f'KPI {index}' for index in range(5)])
+
+        response = self.client.get('/api/kpi/kpis/', {'fields': 'name,secret'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_kpi_list_conditional_get(self):
+        """A client with the current ETag gets a 304 until a KPI changes."""
+        kpi = KPI.objects.create(name='Double', expression='ATTR * 2')
+        response = self.client.get('/api/kpi/kpis/')
+        etag = response['ETag']
+        self.assertNotIn('Last-Modified', response)  # Deletes would not move it forward
+        response = self.client.get('/api/kpi/kpis/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        with self.assertNumQueries(1):  # The version, the page comes from the cache
+            self.assertEqual(self.client.get('/api/kpi/kpis/')['ETag'], etag)
+
+        kpi.name = 'Twice'
+        kpi.save()
+        response = self.client.get('/api/kpi/kpis/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['name'], 'Twice')
+        self.assertNotEqual(response['ETag'], etag)
+
+        etag = response['ETag']
+        kpi.delete()
+        response = self.client.get('/api/kpi/kpis/', HTTP_IF_NONE_MATCH=etag,
+                                   HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+
+    def test_link_validates_registered_assets(self):
+        """Only assets registered by the engine can be linked to a KPI."""
+        kpi = KPI.objects.create(name='Double', expression='ATTR * 2')
+        Asset.objects.create(asset_id='900')
+        response = self.client.post('/api/kpi/assets/link/', {'asset_id': '901', 'kpi': kpi.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('asset_id', response.data)
+
+        response = self.client.post('/api/kpi/assets/link/', {'asset_id': '900', 'kpi': kpi.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(AssetKPI.objects.filter(asset_id='900', kpi=kpi).exists())
+
+    def test_bulk_link(self):
+        """Pairs and pattern rules are linked in one request, invalid items are reported by index."""
+        double = KPI.objects.create(name='Double', expression='ATTR * 2')
+        dog = KPI.objects.create(name='Dog', expression='Regex(ATTR, "^dog")')
+        Asset.objects.bulk_create([Asset(asset_id=asset_id) for asset_id in ('900', '901', '910', '920')])
+        AssetKPI.objects.create(asset_id='900', kpi=double)
+        request = {
+            'links': [
+                {'asset_id': '900', 'kpi': double.id},  # Already linked
+                {'asset_id': '901', 'kpi': double.id},
+                {'asset_id': '999', 'kpi': double.id},
+                {'asset_id': '901', 'kpi': 12345},
+                {'asset_id': '901'},
+            ],
+            'rules': [{'asset_pattern': '9?0', 'kpi': dog.id}],
+        }
+        with self.assertNumQueries(7):
+            response = self.client.post('/api/kpi/assets/link/bulk/', request, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 4)
+        self.assertEqual(response.data['existing'], 1)
+        self.assertEqual(response.data['rules'], [{'rule': 0, 'matched': 3}])
+        self.assertEqual(sorted(error['link'] for error in response.data['errors']), [2, 3, 4])
+        self.assertEqual(sorted(AssetKPI.objects.filter(kpi=dog).values_list('asset_id', flat=True)),
+                         ['900', '910', '920'])
+        self.assertTrue(AssetKPI.objects.filter(asset_id='901', kpi=double).exists())
+
+        response = self.client.post('/api/kpi/assets/link/bulk/', request, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['created'], 0)
+        self.assertEqual(response.data['existing'], 5)
+
+    def test_bulk_link_rule_matching_every_asset(self):
+        """A rule matching thousands of assets checks their existing links without listing their ids in the query."""
+        kpi = KPI.objects.create(name='Double', expression='ATTR * 2')
+        Asset.objects.bulk_create([Asset(asset_id=f'a{i}') for i in range(2000)])
+        AssetKPI.objects.create(asset_id='a0', kpi=kpi)
+        request = {'rules': [{'asset_pattern': 'a*', 'kpi': kpi.id}]}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/kpi/assets/link/bulk/', request, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['created'], response.data['existing']), (1999, 1))
+        selects = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertLess(max(len(sql) for sql in selects), 1000)
+
+        response = self.client.post('/api/kpi/assets/link/bulk/', request, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['existing']), (0, 2000))
+
+    def test_evaluate(self):
+        """A KPI is evaluated over values or records, parsing its expression once per process."""
+        kpi = KPI.objects.create(name='Double', expression=' ATTR * 2 + 1000 ')
+        response = self.client.post(f'/api/kpi/{kpi.id}/evaluate/', {'values': [1, '2.5', 'x']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][:2], [{'value': 1002.0}, {'value': 1005.0}])
+        self.assertIn('Non-numeric', response.data['results'][2]['error'])
+
+        misses = expression_cache.misses
+        record = {'asset_id': '123', 'attribute_id': '101', 'timestamp': 't', 'value': '3'}
+        response = self.client.post(f'/api/kpi/{kpi.id}/evaluate/', {'records': [record]}, format='json')
+        self.assertEqual(response.data['results'],
+                         [{'asset_id': '123', 'attribute_id': 'output_101', 'timestamp': 't', 'value': 1006.0}])
+        self.assertEqual(expression_cache.misses, misses)
+
+        dog = KPI.objects.create(name='Dog', expression='Regex(ATTR, "^dog")')
+        response = self.client.post(f'/api/kpi/{dog.id}/evaluate/', {'values': ['dog_bark', 'cat']}, format='json')
+        self.assertEqual([result['value'] for result in response.data['results']], ['True', 'False'])
+
+        response = self.client.post('/api/kpi/12345/evaluate/', {'values': [1]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(f'/api/kpi/{kpi.id}/evaluate/', {'records': [{'value': 1}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_engine_metrics_endpoint(self):
+        """The metrics endpoint serves the engine's JSON snapshot, or 503 before the first one."""
+        with tempfile.TemporaryDirectory() as directory:
+            metrics_file = os.path.join(directory, 'metrics.json')
+            with override_settings(ENGINE_METRICS_FILE=metrics_file):
+                response = self.client.get('/api/kpi/metrics/')
+                self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+                with open(metrics_file, 'w') as file:
+                    json.dump({'records_processed': 3}, file)
+                response = self.client.get('/api/kpi/metrics/')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['records_processed'], 3)
+
+
+def call_asgi(application, method, path, body=b''):
+    """Sends one HTTP request to an ASGI application, returns (status, headers, JSON body)."""
+    requests = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return requests.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application({'type': 'http', 'method': method, 'path': path}, receive, send))
+    return sent[0]['status'], dict(sent[0]['headers']), json.loads(sent[1]['body'])
+
+
+class IngestionTest(SimpleTestCase):
+    def test_middleware(self):
+        """Batches are acknowledged with 202 once queued, refused with 429 while the queue is full."""
+        engine = mock.Mock()
+        engine.submit.return_value = True
+
+        async def django_application(scope, receive, send):
+            await IngestionMiddleware.respond(send, 200, {'path': scope['path']})
+
+        application = IngestionMiddleware(django_application, engine)
+        body = b'{"asset_id": "123"}\n\n{"asset_id": "124"}\n'
+        status_code, _, data = call_asgi(application, 'POST', '/api/kpi/ingest/', body)
+        self.assertEqual((status_code, data), (202, {'accepted': 2}))
+        engine.submit.assert_called_once_with(['{"asset_id": "123"}', '{"asset_id": "124"}'])
+
+        engine.submit.return_value = False
+        status_code, headers, _ = call_asgi(application, 'POST', '/api/kpi/ingest/', body)
+        self.assertEqual((status_code, headers[b'retry-after']), (429, b'1'))
+        self.assertEqual(call_asgi(application, 'GET', '/api/kpi/ingest/')[0], 405)
+        self.assertEqual(call_asgi(application, 'POST', '/api/kpi/ingest/', b'\n')[0], 400)
+        status_code, _, data = call_asgi(application, 'GET', '/api/kpi/kpis/')
+        self.assertEqual((status_code, data), (200, {'path': '/api/kpi/kpis/'}))
+
+    def test_engine(self):
+        """Queued batches are processed into the output database, the queue is bounded."""
+        with tempfile.TemporaryDirectory() as directory:
+            expressions_db = os.path.join(directory, 'django.db')
+            output_db = os.path.join(directory, 'output.db')
+            connection = sqlite3.connect(expressions_db)
+            connection.executescript("""
+                CREATE TABLE kpi_kpi (id INTEGER PRIMARY KEY, name TEXT, expression TEXT);
+                CREATE TABLE kpi_assetkpi (id INTEGER PRIMARY KEY, asset_id TEXT, kpi_id INTEGER);
+                CREATE TABLE kpi_asset (id INTEGER PRIMARY KEY, asset_id TEXT UNIQUE);
+                INSERT INTO kpi_kpi VALUES (1, 'double', 'ATTR * 2');
+                INSERT INTO kpi_assetkpi VALUES (1, '123', 1);
+            """)
+            connection.close()
+            records = [json.dumps({'asset_id': '123', 'attribute_id': '101', 'timestamp': str(index),
+                                   'value': str(index)}) for index in range(10)]
+
+            engine = IngestionEngine(output_db, expressions_db, queue_size=1)
+            with mock.patch.object(engine, 'start'):  # Not running yet, the queue fills up
+                self.assertTrue(engine.submit(records[:5]))
+                self.assertFalse(engine.submit(records[5:]))
+            engine.start()
+            engine.queue.join()
+            self.assertTrue(engine.submit(records[5:]))
+            engine.stop()
+            self.assertEqual(engine.stats()['batches_rejected'], 1)
+
+            connection = sqlite3.connect(output_db)
+            values = sorted(float(value) for value, in connection.execute('SELECT value FROM processed_data'))
+            connection.close()
+            connection = sqlite3.connect(expressions_db)
+            assets = connection.execute('SELECT asset_id FROM kpi_asset').fetchall()
+            connection.close()
+        self.assertEqual(values, [index * 2.0 for index in range(10)])
+        self.assertEqual(assets, [('123',)])
@@ -1,8 +1,12 @@
 from django.urls import path
-from .views import KPIListCreateView, AssetKPICreateView
+from .views import (KPIListCreateView, AssetKPICreateView, BulkAssetKPILinkView, KPIEvaluateView,
+                    EngineMetricsView)
 
 urlpatterns = [
     path('kpis/', KPIListCreateView.as_view(), name='kpi-list-create'),
     path('assets/link/', AssetKPICreateView.as_view(), name='asset-kpi-link'),
+    path('assets/link/bulk/', BulkAssetKPILinkView.as_view(), name='asset-kpi-bulk-link'),
+    path('<int:pk>/evaluate/', KPIEvaluateView.as_view(), name='kpi-evaluate'),
+    path('metrics/', EngineMetricsView.as_view(), name='engine-metrics'),
     path('', KPIListCreateView.as_view(), name='kpi-list-create'),
 ]
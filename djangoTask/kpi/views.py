@@ -1,14 +1,238 @@
+import fnmatch
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef
 from django.shortcuts import render
-from rest_framework import generics
-from .models import KPI, AssetKPI
-from .serializers import KPISerializer, AssetKPISerializer
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from rest_framework import generics, status
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .engine import evaluate_values
+from .models import KPI, Asset, AssetKPI
+from .serializers import KPISerializer, AssetKPISerializer, BulkLinkItemSerializer, BulkLinkRuleSerializer
+
+# Most links and rules one bulk link request may contain
+MAX_BULK_LINKS = 10000
+
+# Most values or records one evaluation request may contain
+MAX_EVALUATE_BATCH = 10000
+
+
+def kpi_list_etag(request):
+    """
+    Returns the ETag of the KPI list page requested, from one indexed aggregate.
+    Any KPI saved or deleted changes the latest updated_at or the count, and so the ETag.
+    There is no Last-Modified: deleting a KPI does not move the latest updated_at forward.
+    Computed once per request, the conditional GET and the response cache share it.
+    """
+    if not hasattr(request, '_kpi_list_etag'):
+        state = KPI.objects.aggregate(last_modified=Max('updated_at'), count=Count('id'))
+        version = f"{state['last_modified']}|{state['count']}|{request.build_absolute_uri()}"
+        request._kpi_list_etag = hashlib.sha1(version.encode()).hexdigest()
+    return request._kpi_list_etag
+
+
+class KPICursorPagination(CursorPagination):
+    """Keyset pagination on the primary key, a page costs the same however deep it is."""
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
 
 # KPI Endpoints
 class KPIListCreateView(generics.ListCreateAPIView):
+    """
+    Lists KPIs a page at a time (?cursor=, ?page_size=), with only the ?fields= requested.
+    GETs are conditional on the ETag and their responses are cached until a KPI changes.
+    """
     queryset = KPI.objects.all()
     serializer_class = KPISerializer
+    pagination_class = KPICursorPagination
+
+    def requested_fields(self):
+        """Returns the field names of ?fields=, or None to serialize every field."""
+        fields = self.request.query_params.get('fields')
+        if self.request.method != 'GET' or not fields:
+            return None
+        fields = [name.strip() for name in fields.split(',') if name.strip()]
+        unknown = set(fields) - set(KPISerializer.Meta.fields)
+        if unknown:
+            raise ValidationError({'fields': f"Unknown fields: {', '.join(sorted(unknown))}"})
+        return fields
+
+    def get_queryset(self):
+        fields = self.requested_fields()
+        if fields is not None:
+            return self.queryset.only('id', *fields)
+        return self.queryset.all()
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    @method_decorator(condition(etag_func=kpi_list_etag))
+    def get(self, request, *args, **kwargs):
+        cache_key = f"kpi-list:{kpi_list_etag(request)}"
+        data = cache.get(cache_key)
+        if data is None:
+            data = self.list(request, *args, **kwargs).data
+            cache.set(cache_key, data, settings.KPI_LIST_CACHE_TIMEOUT)
+        return Response(data)
 
 # Link Asset to KPI
 class AssetKPICreateView(generics.CreateAPIView):
     queryset = AssetKPI.objects.all()
     serializer_class = AssetKPISerializer
+
+
+class BulkAssetKPILinkView(APIView):
+    """
+    Links many assets to KPIs in one request and one transaction:
+    {"links": [{"asset_id": "123", "kpi": 1}, ...], "rules": [{"asset_pattern": "12*", "kpi": 2}, ...]}.
+    Assets, KPIs and existing links are checked with one query each (and one per rule) whatever
+    the number of items, and the new links are inserted with bulk_create. The query of a rule checks
+    the existing links of the assets it matches with a subquery, so a rule matching every asset does
+    not send their ids as query parameters. Invalid items are reported by index and skipped, links
+    that already exist are counted as such.
+    """
+    def post(self, request):
+        data = request.data if isinstance(request.data, dict) else {}
+        links = data.get('links', [])
+        rules = data.get('rules', [])
+        if not isinstance(links, list) or not isinstance(rules, list) or not (links or rules):
+            return Response({'detail': 'Expected a non empty list of links or rules.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(links) + len(rules) > MAX_BULK_LINKS:
+            return Response({'detail': f'At most {MAX_BULK_LINKS} links and rules per request.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        errors = []
+        links = self.validate_items(links, BulkLinkItemSerializer, 'link', errors)
+        rules = self.validate_items(rules, BulkLinkRuleSerializer, 'rule', errors)
+        kpi_ids = set(KPI.objects.filter(id__in={item['kpi'] for _, item in links + rules})
+                      .values_list('id', flat=True))
+        known_assets = set(Asset.objects.filter(asset_id__in={item['asset_id'] for _, item in links})
+                           .values_list('asset_id', flat=True))
+
+        wanted = []  # (asset_id, kpi id) pairs of the links, in request order
+        for index, item in links:
+            if item['kpi'] not in kpi_ids:
+                errors.append({'link': index, 'errors': {'kpi': [f"KPI {item['kpi']} does not exist."]}})
+            elif item['asset_id'] not in known_assets:
+                errors.append({'link': index, 'errors': {'asset_id': [f'"{item["asset_id"]}" is not a known asset.']}})
+            else:
+                wanted.append((item['asset_id'], item['kpi']))
+        valid_rules = []
+        for index, item in rules:
+            if item['kpi'] in kpi_ids:
+                valid_rules.append((index, item))
+            else:
+                errors.append({'rule': index, 'errors': {'kpi': [f"KPI {item['kpi']} does not exist."]}})
+
+        matched = []
+        with transaction.atomic():
+            linked = set(AssetKPI.objects.filter(asset_id__in={asset_id for asset_id, _ in wanted},
+                                                 kpi_id__in={kpi for _, kpi in wanted})
+                         .values_list('asset_id', 'kpi_id')) if wanted else set()
+            existing = {pair for pair in wanted if pair in linked}  # Requested links that already exist
+            for index, item in valid_rules:
+                assets = (Asset.objects.filter(asset_id__regex=fnmatch.translate(item['asset_pattern']))
+                          .annotate(is_linked=Exists(AssetKPI.objects.filter(kpi_id=item['kpi'],
+                                                                             asset_id=OuterRef('asset_id'))))
+                          .values_list('asset_id', 'is_linked'))
+                count = 0
+                for asset_id, is_linked in assets:
+                    if is_linked:
+                        existing.add((asset_id, item['kpi']))
+                    else:
+                        wanted.append((asset_id, item['kpi']))
+                    count += 1
+                matched.append({'rule': index, 'matched': count})
+            new_links = list(dict.fromkeys(pair for pair in wanted if pair not in existing))
+            AssetKPI.objects.bulk_create([AssetKPI(asset_id=asset_id, kpi_id=kpi) for asset_id, kpi in new_links],
+                                         batch_size=500)
+
+        if new_links:
+            response_status = status.HTTP_201_CREATED
+        elif errors:
+            response_status = status.HTTP_400_BAD_REQUEST
+        else:
+            response_status = status.HTTP_200_OK
+        return Response({
+            'created': len(new_links),
+            'existing': len(existing),
+            'rules': matched,
+            'errors': errors,
+        }, status=response_status)
+
+    @staticmethod
+    def validate_items(items, serializer_class, kind, errors):
+        """Returns the (index, validated data) of the well formed items, adds an error for the others."""
+        valid = []
+        for index, item in enumerate(items):
+            serializer = serializer_class(data=item)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                errors.append({kind: index, 'errors': serializer.errors})
+        return valid
+
+
+class KPIEvaluateView(APIView):
+    """
+    Evaluates a KPI synchronously with the engine's compiled expressions.
+    {"values": [...]} returns {"results": [{"value": ...} or {"error": ...}, ...]}, one per value.
+    {"records": [{"asset_id", "attribute_id", "timestamp", "value"}, ...]} returns the output
+    messages the engine would write for them, or their error, in "results".
+    """
+    def post(self, request, pk):
+        expression = KPI.objects.filter(pk=pk).values_list('expression', flat=True).first()
+        if expression is None:
+            return Response({'detail': f'KPI {pk} does not exist.'}, status=status.HTTP_404_NOT_FOUND)
+        data = request.data if isinstance(request.data, dict) else {}
+        records = data.get('records')
+        values = data.get('values') if records is None else records
+        if not isinstance(values, list) or not values:
+            return Response({'detail': 'Expected a non empty list of values or records.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(values) > MAX_EVALUATE_BATCH:
+            return Response({'detail': f'At most {MAX_EVALUATE_BATCH} values per request.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if records is not None:
+            if not all(isinstance(record, dict) and {'asset_id', 'attribute_id', 'timestamp'} <= record.keys()
+                       for record in records):
+                return Response({'detail': 'Records need an asset_id, an attribute_id and a timestamp.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            values = [record.get('value', '') for record in records]
+
+        try:
+            results = evaluate_values(expression, values)
+        except Exception as e:
+            return Response({'detail': f'The KPI expression does not compile: {e}'},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        if records is None:
+            return Response({'results': [{'value': result} if error is None else {'error': error}
+                                         for result, error in results]})
+        return Response({'results': [
+            {'asset_id': record['asset_id'], 'attribute_id': f"output_{record['attribute_id']}",
+             'timestamp': record['timestamp'], 'value': result} if error is None else {'error': error}
+            for record, (result, error) in zip(records, results)
+        ]})
+
+
+# Engine metrics
+class EngineMetricsView(APIView):
+    """Returns the latest metrics snapshot written by the engine."""
+    def get(self, request):
+        try:
+            with open(settings.ENGINE_METRICS_FILE) as file:
+                return Response(json.load(file))
+        except FileNotFoundError:
+            return Response({'detail': 'The engine has not written any metrics yet.'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
@@ -9,8 +9,16 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up, the engine reads the KPIs of its database
+from kpi.ingest import IngestionEngine, IngestionMiddleware
+
+ingestion_engine = IngestionEngine(settings.ENGINE_OUTPUT_DB, settings.DATABASES['default']['NAME'],
+                                   queue_size=settings.INGEST_QUEUE_SIZE)
+application = IngestionMiddleware(django_application, ingestion_engine)
@@ -128,3 +128,26 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Local memory cache, holds the KPI list responses
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "kpi",
+    }
+}
+
+# Seconds a KPI list response stays cached, it is never served after a KPI changed
+KPI_LIST_CACHE_TIMEOUT = 300
+
+# JSON metrics snapshot periodically written by the engine (Main.py, run from the repository root)
+ENGINE_METRICS_FILE = BASE_DIR.parent / "metrics.json"
+
+# Output database of the engine, records posted to /api/kpi/ingest/ are written to it
+ENGINE_OUTPUT_DB = BASE_DIR.parent / "processed_data.db"
+
+# Batches posted to /api/kpi/ingest/ that may wait for the engine before new ones get a 429
+INGEST_QUEUE_SIZE = 64
+
+# Input file of the engine, the migration creating the asset registry registers its assets
+ENGINE_INPUT_FILE = BASE_DIR / "data.txt"
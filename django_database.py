@@ -1,4 +1,6 @@
 import sqlite3
+import threading
+import time
 
 def view_database(db_name):
     connection = sqlite3.connect(db_name)
@@ -13,30 +15,161 @@ def view_database(db_name):
     connection.close()
 
 
+class ExpressionMap:
+    """
+    In-memory map from asset_id to the KPI expression linked to it.
+    The whole map is loaded with one query joining the 'kpi_kpi' and 'kpi_assetkpi' tables and
+    is reloaded only when the Django database changed: at most every check_interval seconds
+    PRAGMA data_version is read, which changes whenever another connection commits a write.
+    An asset linked to several KPIs gets the first one it was linked to. Asset ids are looked up
+    as strings, like the Django AssetKPI.asset_id field stores them, so numeric JSON ids match too.
+    """
+    def __init__(self, db_name="djangoTask/processed_data.db", check_interval=1.0):
+        self.db_name = db_name
+        self.check_interval = check_interval
+        self.expressions = {}
+        self.loads = 0
+        self.data_version = None
+        self.last_check = None
+        self.connection = None
+        self._lock = threading.Lock()
+
+    def get(self, asset_id):
+        """Returns the expression linked to the asset, or None if it is not linked to a KPI."""
+        if self.last_check is None or time.monotonic() - self.last_check >= self.check_interval:
+            self.refresh_if_changed()
+        return self.expressions.get(str(asset_id))
+
+    def refresh_if_changed(self):
+        """Reloads the map if the database changed since the last load."""
+        with self._lock:
+            self.last_check = time.monotonic()
+            if self.connection is None:
+                # The connection stays open, data_version only reports commits of other connections
+                self.connection = sqlite3.connect(self.db_name, check_same_thread=False)
+            data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != self.data_version:
+                self._load()
+                self.data_version = data_version
+
+    def refresh(self):
+        """Reloads the map now."""
+        with self._lock:
+            self.data_version = None
+        self.refresh_if_changed()
+
+    def _load(self):
+        cursor = self.connection.execute("""
+            SELECT kpi_assetkpi.asset_id, kpi_kpi.expression
+            FROM kpi_assetkpi
+            JOIN kpi_kpi ON kpi_kpi.id = kpi_assetkpi.kpi_id
+            ORDER BY kpi_assetkpi.id
+        """)
+        expressions = {}
+        for asset_id, expression in cursor:
+            # Strip any surrounding whitespace of the expression
+            expressions.setdefault(str(asset_id), expression.strip() if isinstance(expression, str) else expression)
+        self.expressions = expressions  # Replaced at once, readers never see a partial map
+        self.loads += 1
+
+    def stats(self):
+        """Returns the map counters as a dictionary."""
+        return {
+            "size": len(self.expressions),
+            "loads": self.loads,
+        }
+
+    def close(self):
+        with self._lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+                self.data_version = None
+                self.last_check = None
+
+
+class AssetRegistry:
+    """
+    Registers the asset_ids of the input records in the 'kpi_asset' table of the Django database,
+    which the API validates asset links against.
+    The registered ids are loaded once and kept in a set, so only the first record of a new
+    asset costs a write. Without the table (migrations not applied) registration is disabled.
+    """
+    def __init__(self, db_name="djangoTask/processed_data.db", timeout=5.0):
+        self.db_name = db_name
+        self.timeout = timeout
+        self.known = None
+        self.connection = None
+        self.enabled = True
+        self.registered = 0
+
+    def register(self, asset_ids):
+        """Inserts the asset_ids not registered yet, in one transaction."""
+        if not self.enabled:
+            return
+        if self.known is None and not self._load():
+            return
+        new_ids = {str(asset_id) for asset_id in asset_ids} - self.known
+        if not new_ids:
+            return
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO kpi_asset (asset_id) VALUES (?)",
+                                        [(asset_id,) for asset_id in new_ids])
+        self.known |= new_ids
+        self.registered += len(new_ids)
+
+    def _load(self):
+        # Used by the thread processing the records, closed by the main thread
+        self.connection = sqlite3.connect(self.db_name, timeout=self.timeout, check_same_thread=False)
+        try:
+            self.known = {asset_id for asset_id, in self.connection.execute("SELECT asset_id FROM kpi_asset")}
+        except sqlite3.OperationalError as e:
+            print(f"Asset registration disabled, apply the Django migrations: {e}")
+            self.enabled = False
+            self.close()
+            return False
+        return True
+
+    def stats(self):
+        """Returns the registry counters as a dictionary."""
+        return {
+            "known": len(self.known) if self.known is not None else 0,
+            "registered": self.registered,
+        }
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+# Expressions of the Django database the engine reads, loaded on first use
+expression_map = ExpressionMap()
+
+# Asset registry of the Django database the engine writes new assets to
+asset_registry = AssetRegistry()
+
+
 def get_expression(asset_id):
     """
-    This function retrieves the 'expression' for a given 'asset_id' from the database.
-    It joins the 'kpi_kpi' and 'kpi_assetkpi' tables based on the 'kpi_id' and 'asset_id'
-    to fetch the corresponding 'expression' value. If the 'asset_id' is found, it returns
-    the expression as a string, otherwise, it returns None.
+    This function retrieves the 'expression' for a given 'asset_id' from the in-memory map of
+    the Django database. If the 'asset_id' is linked to a KPI, it returns the expression as a
+    string, otherwise, it returns None.
     """
-    connection = sqlite3.connect("djangoTask/processed_data.db")
-    cursor = connection.cursor()
-    cursor.execute("""
-            SELECT kpi_kpi.expression
-            FROM kpi_kpi
-            JOIN kpi_assetkpi ON kpi_kpi.id = kpi_assetkpi.kpi_id
-            WHERE kpi_assetkpi.asset_id = ?
-        """, (asset_id,))
-
-    result = cursor.fetchone()  # Fetch a single result
-
-    if result:
-        # Access the first element of the tuple and strip any surrounding whitespace
-        expression = result[0].strip() if isinstance(result[0], str) else result[0]
-        return expression
-    else:
-        return None
+    return expression_map.get(asset_id)
+
+
+def get_kpi_expressions(db_name="djangoTask/processed_data.db"):
+    """
+    Returns the (name, expression) pairs of every KPI stored in the Django database.
+    """
+    connection = sqlite3.connect(db_name)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT name, expression FROM kpi_kpi ORDER BY id")
+        return cursor.fetchall()
+    finally:
+        connection.close()
 
 
 if __name__ == "__main__":
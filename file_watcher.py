@@ -0,0 +1,144 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Events of the watched directory that concern a file in it: appends, truncation and rotation
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, then len bytes of name
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Waits for changes of a file with Linux inotify, through ctypes.
+    The directory of the file is watched rather than the file itself, so the file being
+    replaced (rotation), deleted or created again is seen as well as appends to it.
+    """
+    def __init__(self, file_path):
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.file_name = os.fsencode(os.path.basename(file_path))
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        directory = os.path.dirname(os.path.abspath(file_path))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+        self.wakeups = 0
+
+    def wait(self, timeout):
+        """Blocks until the file changes or timeout seconds pass, returns True if it changed."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return False
+            self.wakeups += 1
+            if self._read_events():
+                return True
+
+    def _read_events(self):
+        """Reads the queued events, returns True if one concerns the file."""
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return False
+        changed = False
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW or name == self.file_name:  # Events were lost, assume a change
+                changed = True
+        return changed
+
+    def stats(self):
+        return {"wakeups": self.wakeups}
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Waits for changes of a file by polling its size, modification time and inode.
+    The interval adapts to the arrival rate: it is reset to min_interval after a change and
+    doubles on every poll that finds none, up to max_interval.
+    """
+    def __init__(self, file_path, min_interval=0.01, max_interval=1.0):
+        self.file_path = file_path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.last_stat = self._stat()
+        self.wakeups = 0
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def wait(self, timeout):
+        """Blocks until the file changes or timeout seconds pass, returns True if it changed."""
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self._stat()
+            if current != self.last_stat:
+                self.last_stat = current
+                self.interval = self.min_interval
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+            self.wakeups += 1
+            self.interval = min(self.interval * 2, self.max_interval)
+
+    def stats(self):
+        return {"wakeups": self.wakeups, "interval": self.interval}
+
+    def close(self):
+        pass
+
+
+# Ways of waiting for new records, 'auto' uses inotify when available and polling otherwise
+WATCH_MODES = ('auto', 'inotify', 'poll')
+
+
+def create_watcher(file_path, mode='auto'):
+    """Returns a watcher of the file for the mode, one of WATCH_MODES."""
+    if mode not in WATCH_MODES:
+        raise ValueError(f"Unknown watch mode '{mode}', expected one of {', '.join(WATCH_MODES)}")
+    if mode != 'poll':
+        try:
+            return InotifyWatcher(file_path)
+        except (OSError, AttributeError):
+            if mode == 'inotify':
+                raise
+    return PollingWatcher(file_path)
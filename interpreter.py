@@ -1,4 +1,4 @@
-import re
+from regex_cache import match_regex
 from operations import AddOperation, SubOperation, MulOperation, DivOperation
 from parser import *
 
@@ -52,13 +52,19 @@ class Interpreter(NodeVisitor):
         """
         return node.value
 
+    def visit_Attr(self, node):
+        """
+        Visits an ATTR node and returns the attribute value being evaluated.
+        """
+        return self.attr_value
+
     def visit_Regex(self, node):
         """
         Visits a regex node and performs regex matching on the attribute value.
         Returns a boolean indicating if the pattern matches the attribute value.
         """
         pattern = node.pattern.value
-        return str(bool(re.match(pattern, self.attr_value)))
+        return match_regex(pattern, self.attr_value)
 
     def interpret(self):
         """
@@ -1,96 +1,99 @@
+import re
+import string
 from Token import *
 
+# Operators and reserved words always produce the same token, so one shared instance is used for each
+OPERATOR_TOKENS = {
+    '+': Token(PLUS, '+'),
+    '-': Token(MINUS, '-'),
+    '*': Token(MUL, '*'),
+    '/': Token(DIV, '/'),
+    '(': Token(LPAREN, '('),
+    ')': Token(RPAREN, ')'),
+    ',': Token(COMMA, ',')
+}
+KEYWORD_TOKENS = {
+    'Regex': Token(REGEX, 'Regex'),
+    'ATTR': Token(ATTR, 'ATTR')
+}
+
+# Kind of token each ASCII character starts, other characters are classified with str methods
+SPACE, NUMBER, WORD, QUOTE = range(4)
+CHARACTER_CLASSES = {'"': QUOTE}
+CHARACTER_CLASSES.update(dict.fromkeys(string.whitespace, SPACE))
+CHARACTER_CLASSES.update(dict.fromkeys(string.digits + '.', NUMBER))
+CHARACTER_CLASSES.update(dict.fromkeys(string.ascii_letters, WORD))
+
+NUMBER_PATTERN = re.compile(r'[0-9]+(?:\.[0-9]*)?|\.[0-9]+')
+WORD_PATTERN = re.compile(r'[^\W\d_][^\W_]*')
+
+
+class LexerError(Exception):
+    """Raised when the input contains something that is not a valid token."""
+    pass
+
+
 class Lexer:
     """
     Responsible for breaking down the input string (equation) into tokens.
+    The whole input is tokenized in a single pass driven by a table of character classes.
     """
     def __init__(self, text):
         self.text = text
-        self.pos = 0
-        self.current_char = self.text[self.pos]
-
-    def advance(self):
-        """Moves to the next character in the input."""
-        self.pos += 1
-        self.current_char = self.text[self.pos] if self.pos < len(self.text) else None
-
-    def skip_whitespace(self):
-        """Skips over whitespace characters."""
-        while self.current_char is not None and self.current_char.isspace():
-            self.advance()
-
-    def integer(self):
-        """Handles numeric values."""
-        result = ''
-        while self.current_char is not None and self.current_char.isdigit():
-            result += self.current_char
-            self.advance()
-        return int(result)
+        self.tokens = self.tokenize(text)
+        self.next_token = iter(self.tokens).__next__
+
+    def tokenize(self, text):
+        """Splits the text into a list of tokens, raises LexerError on invalid input."""
+        tokens = []
+        append = tokens.append
+        operators = OPERATOR_TOKENS
+        classes = CHARACTER_CLASSES
+        pos = 0
+        end = len(text)
+        while pos < end:
+            char = text[pos]
+            token = operators.get(char)
+            if token is not None:
+                append(token)
+                pos += 1
+                continue
 
-    def string(self):
-        """Handles string literals for regex patterns."""
-        result = ''
-        self.advance()  # Skip the opening quote
-        while self.current_char is not None and self.current_char != '"':
-            result += self.current_char
-            self.advance()
-        self.advance()  # Skip the closing quote
-        return result
+            kind = classes.get(char)
+            if kind is None:
+                kind = SPACE if char.isspace() else WORD if char.isalpha() else None
+
+            if kind == SPACE:
+                pos += 1
+            elif kind == NUMBER:
+                found = NUMBER_PATTERN.match(text, pos)
+                if found is None:  # A lone '.'
+                    raise LexerError(f'Invalid character {char!r} at position {pos} (lexical analysis).')
+                value = found.group()
+                append(Token(FLOAT, float(value)) if '.' in value else Token(INTEGER, int(value)))
+                pos = found.end()
+            elif kind == WORD:
+                found = WORD_PATTERN.match(text, pos)
+                token = KEYWORD_TOKENS.get(found.group())
+                if token is None:
+                    raise LexerError(f'Unknown identifier {found.group()!r} at position {pos} (lexical analysis).')
+                append(token)
+                pos = found.end()
+            elif kind == QUOTE:
+                closing = text.find('"', pos + 1)
+                if closing == -1:
+                    raise LexerError(f'Unterminated string starting at position {pos} (lexical analysis).')
+                append(Token(STRING, text[pos + 1:closing]))
+                pos = closing + 1
+            else:
+                raise LexerError(f'Invalid character {char!r} at position {pos} (lexical analysis).')
+        return tokens
 
     def get_next_token(self):
         """
-        Identifies the next token in the input string.
-        Returns a token object or raises an error if no valid token is found.
+        Returns the next token of the input, or None once the input is exhausted.
         """
-        while self.current_char is not None:
-            if self.current_char.isspace():
-                self.skip_whitespace()
-                continue
-
-            if self.current_char.isdigit():
-                return Token(INTEGER, self.integer())
-
-            if self.current_char.isalpha():
-                word = ''
-                while self.current_char is not None and self.current_char.isalnum():
-                    word += self.current_char
-                    self.advance()
-                if word == 'Regex':
-                    return Token(REGEX, word)
-                elif word == 'ATTR':
-                    return Token(ATTR, word)
-
-            if self.current_char == '+':
-                self.advance()
-                return Token(PLUS, '+')
-
-            if self.current_char == '-':
-                self.advance()
-                return Token(MINUS, '-')
-
-            if self.current_char == '*':
-                self.advance()
-                return Token(MUL, '*')
-
-            if self.current_char == '/':
-                self.advance()
-                return Token(DIV, '/')
-
-            if self.current_char == '(':
-                self.advance()
-                return Token(LPAREN, '(')
-
-            if self.current_char == ')':
-                self.advance()
-                return Token(RPAREN, ')')
-
-            if self.current_char == ',':
-                self.advance()
-                return Token(COMMA, ',')
-
-            if self.current_char == '"':
-                return Token(STRING, self.string())
-
-            raise Exception('Invalid character (lexical analysis).')
-
-        return None
+        try:
+            return self.next_token()
+        except StopIteration:
+            return None
@@ -0,0 +1,226 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds of the latency histogram buckets, from 10 microseconds to 1 second
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 0.1, 0.25, 1.0)
+
+# Pipeline stages with a latency histogram.
+# lookup is the KPI expression of the asset, expression_cache the compiled expression (parsed on a miss).
+# evaluate_batch times the evaluation of a whole group in batch mode, the others time one record.
+# In the staged pipeline, write is the hand-off to the writer stage and sink the write to the data sink.
+STAGES = ('decode', 'lookup', 'expression_cache', 'evaluate', 'evaluate_batch', 'write', 'sink')
+
+# Collector values that only increase, exported as Prometheus counters. The others are gauges.
+COLLECTOR_COUNTERS = frozenset((
+    'hits', 'misses', 'flushes', 'rows_written', 'checkpoints', 'duplicates_dropped', 'loads', 'registered',
+    'wakeups', 'guarded_matches', 'timeouts', 'worker_restarts',
+))
+
+# Most (asset, KPI) pairs with their own error counter, later pairs are counted under 'other'
+MAX_ERROR_SERIES = 1000
+
+
+class Histogram:
+    """
+    Fixed bucket histogram, like a Prometheus histogram.
+    Observing a value is a binary search and three additions, cheap enough for every record.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last count is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts, total, count):
+        """Adds the counts, sum and count of another histogram with the same buckets."""
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+    def cumulative_counts(self):
+        """Returns (upper bound, count of values <= bound) pairs, ending with '+Inf'."""
+        pairs = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(bound): count for bound, count in self.cumulative_counts()},
+        }
+
+
+class PipelineMetrics:
+    """
+    Counters and latency histograms of the processing pipeline.
+    Counters and histograms written by a single thread are updated in place without locks.
+    The error counters are updated by several threads in the staged pipeline, so they and the
+    collectors are changed and copied under a lock, and exporting (from any thread) works on copies.
+    Components like caches register a collector, a function returning a dictionary of their
+    counters, which is read at export time only.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.records_read = 0
+        self.records_processed = 0
+        self.records_failed = 0
+        self.errors = {}  # (asset_id, expression) -> number of failed records
+        self.queue_lag_bytes = 0
+        self.collectors = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        """Records the time spent by one record (or batch) in a stage."""
+        self.stages[stage].observe(seconds)
+
+    def take_stages(self):
+        """
+        Returns {stage: (counts, sum, count)} of the stages observed since the last call and
+        resets them. Worker processes send these to the process exporting the metrics.
+        """
+        taken = {}
+        for stage, histogram in self.stages.items():
+            if histogram.count:
+                taken[stage] = (histogram.counts, histogram.sum, histogram.count)
+                self.stages[stage] = Histogram(histogram.buckets)
+        return taken
+
+    def merge_stages(self, stages):
+        """Adds stage histograms returned by take_stages of another PipelineMetrics."""
+        for stage, (counts, total, count) in stages.items():
+            self.stages[stage].merge(counts, total, count)
+
+    def record_error(self, asset_id, expression):
+        """Counts a failed record of an asset and the KPI expression it was evaluated with."""
+        key = (str(asset_id), str(expression))
+        with self._lock:
+            self.records_failed += 1
+            if key not in self.errors and len(self.errors) >= MAX_ERROR_SERIES:
+                key = ('other', 'other')
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def add_collector(self, name, collector):
+        """Registers a function returning a dictionary of counters, exported under the name."""
+        with self._lock:
+            self.collectors[name] = collector
+
+    def _copy_shared(self):
+        """Returns (records_failed, errors, collectors) copied under the lock."""
+        with self._lock:
+            return self.records_failed, dict(self.errors), dict(self.collectors)
+
+    def snapshot(self):
+        """Returns every metric as a JSON serializable dictionary."""
+        uptime = time.time() - self.started
+        records_failed, errors, collectors = self._copy_shared()
+        return {
+            "timestamp": time.time(),
+            "uptime_seconds": uptime,
+            "records_read": self.records_read,
+            "records_processed": self.records_processed,
+            "records_failed": records_failed,
+            "records_per_second": self.records_processed / uptime if uptime > 0 else 0.0,
+            "queue_lag_bytes": self.queue_lag_bytes,
+            "stages": {stage: histogram.to_dict() for stage, histogram in self.stages.items()},
+            "errors": [{"asset_id": asset_id, "kpi": expression, "count": count}
+                       for (asset_id, expression), count in errors.items()],
+            **{name: collector() for name, collector in collectors.items()},
+        }
+
+    def prometheus_text(self):
+        """Renders the metrics in the Prometheus text exposition format."""
+        records_failed, errors, collectors = self._copy_shared()
+        lines = [
+            "# HELP kpi_stage_duration_seconds Time spent by records in each pipeline stage.",
+            "# TYPE kpi_stage_duration_seconds histogram",
+        ]
+        for stage, histogram in self.stages.items():
+            for bound, count in histogram.cumulative_counts():
+                lines.append(f'kpi_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'kpi_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'kpi_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+        for name, value, help_text in (
+                ("records_read", self.records_read, "Records read from the input file."),
+                ("records_processed", self.records_processed, "Records evaluated and written to the sink."),
+                ("records_failed", records_failed, "Records that failed to be processed.")):
+            lines.append(f"# HELP kpi_{name}_total {help_text}")
+            lines.append(f"# TYPE kpi_{name}_total counter")
+            lines.append(f"kpi_{name}_total {value}")
+
+        lines.append("# HELP kpi_errors_total Failed records per asset and KPI expression.")
+        lines.append("# TYPE kpi_errors_total counter")
+        for (asset_id, expression), count in errors.items():
+            lines.append(f'kpi_errors_total{{asset_id="{escape_label(asset_id)}",'
+                         f'kpi="{escape_label(expression)}"}} {count}')
+
+        lines.append("# HELP kpi_queue_lag_bytes Bytes of the input file not read yet.")
+        lines.append("# TYPE kpi_queue_lag_bytes gauge")
+        lines.append(f"kpi_queue_lag_bytes {self.queue_lag_bytes}")
+
+        for name, collector in collectors.items():
+            for key, value in collector().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    kind, metric = ("counter", f"kpi_{name}_{key}_total") if key in COLLECTOR_COUNTERS \
+                        else ("gauge", f"kpi_{name}_{key}")
+                    lines.append(f"# HELP {metric} {key.replace('_', ' ').capitalize()} "
+                                 f"of the {name.replace('_', ' ')}.")
+                    lines.append(f"# TYPE {metric} {kind}")
+                    lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    """Escapes a Prometheus label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomically(path, text):
+    """Replaces the file with the text, readers never see a partially written file."""
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as file:
+        file.write(text)
+    os.replace(temporary_path, path)
+
+
+class MetricsExporter:
+    """
+    Periodically rewrites a Prometheus text file (for the node exporter textfile collector)
+    and a JSON snapshot (served by the Django metrics endpoint).
+    """
+    def __init__(self, metrics, prometheus_file="metrics.prom", json_file="metrics.json", interval=10.0):
+        self.metrics = metrics
+        self.prometheus_file = prometheus_file
+        self.json_file = json_file
+        self.interval = interval
+        self.last_write = None
+
+    def write_if_due(self):
+        """Writes the files if the interval has passed since the last write."""
+        if self.last_write is None or time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        """Writes both files now."""
+        self.last_write = time.monotonic()
+        if self.prometheus_file:
+            write_atomically(self.prometheus_file, self.metrics.prometheus_text())
+        if self.json_file:
+            write_atomically(self.json_file, json.dumps(self.metrics.snapshot(), indent=2))
+
+
+# Metrics of the processing pipeline of this process
+pipeline_metrics = PipelineMetrics()
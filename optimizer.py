@@ -0,0 +1,135 @@
+import sys
+from django_database import get_kpi_expressions
+from interpreter import *
+
+
+def is_power_of_two(value):
+    """Returns True for the integers 1, 2, 4, 8, ..."""
+    return type(value) is int and value > 0 and value & (value - 1) == 0
+
+
+class Optimizer(NodeVisitor):
+    """
+    Simplifies an AST between parsing and evaluation without changing any result.
+    - Constant folding: subtrees without ATTR are computed once with the same Operation classes
+      the Interpreter uses. Subtrees that raise (e.g. 1/0) are kept so they still raise per record.
+    - Identity elimination: e*1, 1*e, e/1 and e-0 become e. e+0 is kept because it turns -0.0 into 0.0.
+    - Reassociation of constants: (e*c1)*c2 becomes e*(c1*c2) when both constants are powers of two,
+      the only case where floating point multiplication gives the same result after reassociation.
+    Identities and reassociation assume ATTR is numeric, they are skipped when numeric_attr is False.
+    """
+    def __init__(self, numeric_attr=True):
+        self.numeric_attr = numeric_attr
+        self.nodes_removed = 0
+        self.operations = {
+            'PLUS': AddOperation(),
+            'MINUS': SubOperation(),
+            'MUL': MulOperation(),
+            'DIV': DivOperation()
+        }
+
+    def optimize(self, tree):
+        """Returns the optimized tree and records how many nodes were removed."""
+        before = count_nodes(tree)
+        tree = self.visit(tree)
+        self.nodes_removed = before - count_nodes(tree)
+        return tree
+
+    def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+
+        if isinstance(left, Num) and isinstance(right, Num):
+            folded = self.fold(node.op.type, left.value, right.value)
+            if folded is not None:
+                return folded
+
+        if self.numeric_attr:
+            simplified = self.simplify(left, node.op, right)
+            if simplified is not None:
+                return simplified
+
+        return BinOp(left=left, op=node.op, right=right)
+
+    def visit_Num(self, node):
+        return node
+
+    def visit_Attr(self, node):
+        return node
+
+    def visit_Regex(self, node):
+        return node
+
+    def fold(self, op_type, left, right):
+        """Computes a constant operation, returns None if it cannot be folded."""
+        operation = self.operations.get(op_type)
+        if operation is None:
+            return None
+        try:
+            value = operation.apply(left, right)
+        except Exception:  # Let the error happen at evaluation time, like before
+            return None
+        return Num(Token(FLOAT if isinstance(value, float) else INTEGER, value))
+
+    def simplify(self, left, op, right):
+        """Applies identity elimination and constant reassociation, returns None if nothing applies."""
+        left_const = left.value if isinstance(left, Num) else None
+        right_const = right.value if isinstance(right, Num) else None
+
+        if op.type == MUL:
+            if right_const == 1 and is_arithmetic(left):
+                return left
+            if left_const == 1 and is_arithmetic(right):
+                return right
+            if right_const is not None:
+                return self.reassociate(left, op, right_const)
+            if left_const is not None:
+                return self.reassociate(right, op, left_const)
+        elif op.type == DIV:
+            if right_const == 1 and is_arithmetic(left):
+                return left
+        elif op.type == MINUS:
+            if right_const == 0 and is_arithmetic(left):
+                return left
+        return None
+
+    def reassociate(self, node, op, constant):
+        """Merges constant * (e * c) into e * (c * constant) for powers of two."""
+        if not is_power_of_two(constant) or not isinstance(node, BinOp) or node.op.type != MUL:
+            return None
+
+        if isinstance(node.right, Num):
+            operand, inner = node.left, node.right.value
+        elif isinstance(node.left, Num):
+            operand, inner = node.right, node.left.value
+        else:
+            return None
+
+        if not is_power_of_two(inner) or not is_arithmetic(operand):
+            return None
+        product = inner * constant
+        if product.bit_length() > 1024:  # The product must still convert to a float exactly
+            return None
+        return BinOp(left=operand, op=op, right=Num(Token(INTEGER, product)))
+
+
+def report_catalogue(db_name):
+    """Prints how many nodes the optimizer removes from every KPI expression in the Django database."""
+    total_before = total_removed = 0
+    for name, expression in get_kpi_expressions(db_name):
+        try:
+            tree = Parser(Lexer(expression)).parse()
+        except Exception as e:
+            print(f"{name}: {expression!r} could not be parsed: {e}")
+            continue
+        optimizer = Optimizer(numeric_attr="Regex" not in expression)
+        optimizer.optimize(tree)
+        before = count_nodes(tree)
+        total_before += before
+        total_removed += optimizer.nodes_removed
+        print(f"{name}: {expression!r} {before} nodes, {optimizer.nodes_removed} removed")
+    print(f"Total: {total_before} nodes, {total_removed} removed")
+
+
+if __name__ == "__main__":
+    report_catalogue(sys.argv[1] if len(sys.argv) > 1 else "djangoTask/processed_data.db")
@@ -8,7 +8,6 @@ class Parser:
     def __init__(self, lexer):
         self.lexer = lexer
         self.current_token = self.lexer.get_next_token()
-        self.attr_value = None
 
     def eat(self, token_type):
         """Consumes the current token if it matches the expected type."""
@@ -20,12 +19,14 @@ class Parser:
     def factor(self):
         """Parses factors (numbers, attributes, parentheses, or regex)."""
         token = self.current_token
-        if token.type == INTEGER:
-            self.eat(INTEGER)
+        if token is None:
+            raise Exception('Unexpected end of equation (parsing).')
+        if token.type in (INTEGER, FLOAT):
+            self.eat(token.type)
             return Num(token)
         elif token.type == ATTR:
             self.eat(ATTR)
-            return Num(Token(INTEGER, self.attr_value))
+            return Attr(token)
         elif token.type == LPAREN:
             self.eat(LPAREN)
             node = self.expr()
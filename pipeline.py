@@ -0,0 +1,151 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from metrics import pipeline_metrics
+
+
+def failed(task):
+    """Returns True if the task is done with an exception other than its cancellation."""
+    return task.done() and not task.cancelled() and task.exception() is not None
+
+
+class OutputBuffer:
+    """Data sink keeping the output messages of the evaluator stage until the writer stage takes them."""
+    def __init__(self):
+        self.messages = []
+
+    def write_message(self, message):
+        self.messages.append(message)
+
+    def take(self):
+        messages, self.messages = self.messages, []
+        return messages
+
+
+class StagedPipeline:
+    """
+    Runs the engine as three asyncio stages connected by bounded queues:
+    the reader reads batches of records from the file, the evaluator processes them with a
+    DataProcessor writing into an OutputBuffer and the writer writes the outputs to the data sink.
+    Blocking work runs in one thread per stage, so a slow disk write does not stop the
+    evaluation and the evaluation does not stop the reading. When a stage falls behind, the
+    queue in front of it fills up and the stages before it wait (backpressure).
+    The data sink is created by sink_factory in the writer thread, which is the only one using it.
+    Each batch carries the reader position after it to the writer, which checkpoints it once
+    the outputs of the batch are written.
+    """
+    def __init__(self, file_reader, watcher, processor, output_buffer, sink_factory, exporter=None,
+                 metrics=pipeline_metrics, queue_size=4, flush_interval=1.0):
+        self.file_reader = file_reader
+        self.watcher = watcher
+        self.processor = processor
+        self.output_buffer = output_buffer
+        self.sink_factory = sink_factory
+        self.exporter = exporter
+        self.metrics = metrics
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.data_sink = None
+        self.read_queue = None
+        self.write_queue = None
+        self.stopping = False
+        self.executors = {stage: ThreadPoolExecutor(max_workers=1, thread_name_prefix=stage)
+                          for stage in ('reader', 'evaluator', 'writer')}
+
+    def stats(self):
+        """Returns the depth of each queue, a full queue is in front of the slowest stage."""
+        return {
+            "read_queue_depth": self.read_queue.qsize() if self.read_queue else 0,
+            "write_queue_depth": self.write_queue.qsize() if self.write_queue else 0,
+            "queue_size": self.queue_size,
+        }
+
+    async def in_stage(self, stage, function, *args):
+        """Runs a blocking function in the thread of the stage."""
+        return await asyncio.get_running_loop().run_in_executor(self.executors[stage], function, *args)
+
+    async def run(self):
+        """
+        Runs the stages until one of them fails or the task is cancelled.
+        Either way the batches already read are evaluated and written before the sink is closed.
+        """
+        self.read_queue = asyncio.Queue(self.queue_size)
+        self.write_queue = asyncio.Queue(self.queue_size)
+        self.data_sink = await self.in_stage('writer', self.sink_factory)
+        self.metrics.add_collector("sink", self.data_sink.stats)
+        self.metrics.add_collector("pipeline", self.stats)
+
+        tasks = [asyncio.create_task(stage()) for stage in (self.read, self.evaluate, self.write)]
+        try:
+            # The stages run until they are stopped, so this returns when one of them failed
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            await self.stop(tasks)
+            for executor in self.executors.values():
+                executor.shutdown()
+        for task in tasks:
+            if failed(task):
+                raise task.exception()
+
+    async def stop(self, tasks):
+        """Stops the reader and lets the other stages drain their queue, or cancels them after a failure."""
+        self.stopping = True
+        if any(failed(task) for task in tasks):
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.in_stage('writer', self.data_sink.close)  # Flushes the pending messages
+
+    async def read(self):
+        while not self.stopping:
+            records, position = await self.in_stage('reader', self.read_batch)
+            if records:
+                await self.read_queue.put((records, position))  # Waits while the evaluator is behind
+            else:
+                # Wakes up at least every flush interval to notice a stop
+                await self.in_stage('reader', self.watcher.wait, self.flush_interval)
+        await self.read_queue.put(None)  # Ends the evaluator once the queued batches are done
+
+    def read_batch(self):
+        records = self.file_reader.read_new_records()
+        self.metrics.queue_lag_bytes = self.file_reader.unread_bytes()
+        if self.exporter is not None:
+            self.exporter.write_if_due()
+        return records, self.file_reader.position()
+
+    async def evaluate(self):
+        while True:
+            batch = await self.read_queue.get()
+            if batch is None:
+                break
+            records, position = batch
+            outputs = await self.in_stage('evaluator', self.evaluate_batch, records)
+            # Batches without outputs are passed on too, their position is checkpointed
+            await self.write_queue.put((outputs, position))  # Waits while the writer is behind
+        await self.write_queue.put(None)
+
+    def evaluate_batch(self, records):
+        self.processor.process_records(records)
+        return self.output_buffer.take()
+
+    async def write(self):
+        while True:
+            try:
+                batch = await asyncio.wait_for(self.write_queue.get(), self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.in_stage('writer', self.data_sink.flush_if_due)
+                continue
+            if batch is None:
+                break
+            await self.in_stage('writer', self.write_batch, *batch)
+
+    def write_batch(self, outputs, position=None):
+        for output_message in outputs:
+            try:
+                start = perf_counter()
+                self.data_sink.write_message(output_message)
+                self.metrics.observe('sink', perf_counter() - start)
+            except Exception as e:
+                self.metrics.record_error(output_message["asset_id"], None)
+                print(f"Error writing output: {output_message}, Error: {e}")
+        self.data_sink.checkpoint(position)
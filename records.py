@@ -0,0 +1,71 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson and msgspec are optional, the json module is used without them
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# JSON parsers a RecordDecoder can use, 'auto' picks the fastest one installed
+JSON_DECODERS = ('auto', 'orjson', 'msgspec', 'json')
+
+
+def get_json_loads(name):
+    """Returns the function parsing a JSON document with the named parser."""
+    if name not in JSON_DECODERS:
+        raise ValueError(f"Unknown JSON decoder '{name}', expected one of {', '.join(JSON_DECODERS)}")
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'msgspec' if msgspec is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError("The orjson JSON decoder is not installed")
+        return orjson.loads
+    if name == 'msgspec':
+        if msgspec is None:
+            raise ValueError("The msgspec JSON decoder is not installed")
+        return msgspec.json.decode
+    return json.loads
+
+
+class Record:
+    """An input record decoded once, with the raw line it came from for error reports."""
+    __slots__ = ('raw', 'asset_id', 'attribute_id', 'timestamp', 'value')
+
+    def __init__(self, raw, asset_id, attribute_id, timestamp, value):
+        self.raw = raw
+        self.asset_id = asset_id
+        self.attribute_id = attribute_id
+        self.timestamp = timestamp
+        self.value = value
+
+    def __repr__(self):
+        return f"Record({self.raw!r})"
+
+
+class RecordDecoder:
+    """Decodes input lines into Records with a pluggable JSON parser."""
+    def __init__(self, name='auto'):
+        self.set_decoder(name)
+
+    def set_decoder(self, name):
+        """Switches the JSON parser, one of JSON_DECODERS."""
+        self.loads = get_json_loads(name)
+        self.name = name
+
+    def decode(self, line):
+        """
+        Returns the Record of a line. Raises if it is not a JSON object, KeyError if it has no
+        asset_id, attribute_id or timestamp. A missing value is an empty string.
+        """
+        message_obj = self.loads(line)
+        if not isinstance(message_obj, dict):
+            raise ValueError(f"Expected a JSON object, got {type(message_obj).__name__}")
+        return Record(line, message_obj['asset_id'], message_obj['attribute_id'], message_obj['timestamp'],
+                      message_obj.get("value", ""))
+
+
+# Decoder of the input records of this process
+record_decoder = RecordDecoder()
@@ -0,0 +1,150 @@
+import re
+import threading
+from collections import OrderedDict
+from regex_guard import GuardedMatcher, GuardedPattern, is_safe
+
+# Characters with a special meaning in a regex, a literal prefix stops at the first one
+METACHARACTERS = set('.^$*+?{}[]\\|()')
+QUANTIFIERS = set('*+?{')
+
+
+class PatternCache:
+    """
+    LRU cache of compiled regex patterns keyed by the pattern text.
+    Replaces the small internal cache of the re module, which thrashes with thousands of patterns.
+    With a guard, patterns prone to catastrophic backtracking are replaced by a GuardedPattern
+    that runs them in the guard's worker process with a deadline.
+    """
+    def __init__(self, maxsize=10000, guard=None):
+        self.maxsize = maxsize
+        self.guard = guard
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pattern):
+        """Returns the compiled pattern, compiling it on a miss."""
+        with self._lock:
+            compiled = self._entries.get(pattern)
+            if compiled is not None:
+                self._entries.move_to_end(pattern)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        compiled = re.compile(pattern)
+        if self.guard is not None and not is_safe(pattern):
+            compiled = GuardedPattern(pattern, self.guard)
+
+        with self._lock:
+            self._entries[pattern] = compiled
+            self._entries.move_to_end(pattern)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)  # Evict the least recently used pattern
+        return compiled
+
+    def clear(self):
+        """Drops every cached pattern and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns the cache counters as a dictionary."""
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Compiled patterns shared by every backend, unsafe ones are matched by pattern_guard
+pattern_guard = GuardedMatcher()
+pattern_cache = PatternCache(guard=pattern_guard)
+
+
+def match_regex(pattern, value):
+    """
+    Matches the value against the pattern from the start, like re.match.
+    Returns the strings 'True' or 'False', the result of a Regex KPI.
+    """
+    return 'True' if pattern_cache.get(pattern).match(value) else 'False'
+
+
+def literal_prefix(pattern):
+    """
+    Returns (prefix, exact) for a pattern used with re.match.
+    prefix is literal text every match has to start with (possibly empty) and exact is True
+    when the pattern is nothing but that text, so testing the prefix alone decides the match.
+    The prefix is conservative: anything not understood ends it.
+    """
+    if '|' in pattern:  # Alternatives can start with anything
+        return '', False
+
+    prefix = []
+    pos = 1 if pattern.startswith('^') else 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '\\':
+            escaped = pattern[pos + 1:pos + 2]
+            if not escaped or escaped.isalnum():  # Classes like \d and references like \1
+                break
+            literal, step = escaped, 2
+        elif char in METACHARACTERS:
+            break
+        else:
+            literal, step = char, 1
+
+        if pattern[pos + step:pos + step + 1] in QUANTIFIERS:
+            break  # The literal is optional or repeated
+        prefix.append(literal)
+        pos += step
+
+    return ''.join(prefix), pos == len(pattern)
+
+
+class MultiPatternMatcher:
+    """
+    Matches one value against many regex patterns at once.
+    Patterns are indexed by their literal prefix, so a value is only run through the patterns
+    whose prefix it starts with (plus those without a prefix). Patterns that are plain literals
+    are decided by the prefix lookup alone, without running the regex engine.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        self.unprefixed = []  # Patterns that have to be tried for every value
+        self.prefixes = {}  # prefix length -> prefix -> [(pattern, compiled or None if exact)]
+        for pattern in self.patterns:
+            compiled = pattern_cache.get(pattern)
+            prefix, exact = literal_prefix(pattern)
+            if prefix:
+                entry = (pattern, None if exact else compiled)
+                self.prefixes.setdefault(len(prefix), {}).setdefault(prefix, []).append(entry)
+            else:
+                self.unprefixed.append((pattern, compiled))
+        self.lengths = sorted(self.prefixes)
+
+    def match_all(self, value):
+        """
+        Returns a dictionary mapping every pattern to whether re.match would match the value.
+        """
+        if not isinstance(value, str):
+            raise TypeError(f"expected string or bytes-like object, got '{type(value).__name__}'")
+
+        results = dict.fromkeys(self.patterns, False)
+        for pattern, compiled in self.unprefixed:
+            if compiled.match(value):
+                results[pattern] = True
+        for length in self.lengths:
+            if length > len(value):
+                break
+            for pattern, compiled in self.prefixes[length].get(value[:length], ()):
+                if compiled is None or compiled.match(value):
+                    results[pattern] = True
+        return results
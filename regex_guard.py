@@ -0,0 +1,251 @@
+import multiprocessing
+import re
+import threading
+
+# Seconds the worker process may take to start, outside of the deadline of the matches
+START_TIMEOUT = 30.0
+
+# {n}, {n,} and {n,m} repetition counts
+REPEAT_PATTERN = re.compile(r'\{(\d*)(,?)(\d*)\}')
+
+
+class RegexTimeoutError(Exception):
+    """Raised when a guarded regex match does not finish before its deadline."""
+    pass
+
+
+def read_quantifier(pattern, pos):
+    """
+    Reads the quantifier starting at pos, if any.
+    Returns (unbounded, new position) where unbounded is None when there is no quantifier,
+    True for *, + and {n,} and False for bounded ones like ? and {n,m}.
+    """
+    if pos >= len(pattern):
+        return None, pos
+    char = pattern[pos]
+    if char in '*+':
+        unbounded, pos = True, pos + 1
+    elif char == '?':
+        unbounded, pos = False, pos + 1
+    elif char == '{':
+        found = REPEAT_PATTERN.match(pattern, pos)
+        if found is None or not (found.group(1) or found.group(3)):  # A literal '{'
+            return None, pos
+        unbounded, pos = bool(found.group(2)) and not found.group(3), found.end()
+    else:
+        return None, pos
+
+    if pattern[pos:pos + 1] in ('?', '+'):  # Lazy or possessive form of the quantifier
+        pos += 1
+    return unbounded, pos
+
+
+def skip_group_prefix(pattern, pos):
+    """Skips the extension after '(?', like ':', 'P<name>' or '<=', returns the new position."""
+    if pattern.startswith('P<', pos):
+        return pattern.find('>', pos) + 1 or len(pattern)
+    if pattern.startswith(('<=', '<!'), pos):
+        return pos + 2
+    while pos < len(pattern) and (pattern[pos].isalpha() or pattern[pos] == '-'):  # Inline flags
+        pos += 1
+    if pattern[pos:pos + 1] in (':', '=', '!', '>'):
+        pos += 1
+    return pos
+
+
+def skip_class(pattern, pos):
+    """Skips the character class starting at pos, returns the position after its closing ']'."""
+    pos += 1
+    if pattern[pos:pos + 1] == '^':
+        pos += 1
+    if pattern[pos:pos + 1] == ']':  # A ']' right after the opening bracket is a literal
+        pos += 1
+    while pos < len(pattern) and pattern[pos] != ']':
+        pos += 2 if pattern[pos] == '\\' else 1
+    return pos + 1
+
+
+def first_token(pattern, pos):
+    """
+    Returns what the token at pos starts a match with: the literal character, or None for
+    anything that can match several characters (a class, '.', an escape like \\d, a group, an
+    anchor or an optional token).
+    """
+    char = pattern[pos:pos + 1]
+    if char in ('', '|', ')'):
+        return ''  # An empty alternative
+    end = pos + 2 if char == '\\' else pos + 1
+    if pattern[end:end + 1] in ('?', '*') or pattern.startswith(('{0,', '{0}'), end):
+        return None  # The alternative can start with what follows
+    if char == '\\':
+        escaped = pattern[pos + 1:pos + 2]
+        return escaped if escaped and not escaped.isalnum() else None
+    if char in ('[', '.', '(', '^', '$'):
+        return None
+    return char
+
+
+def alternatives_overlap(firsts):
+    """Returns True if two of the alternatives can start with the same character."""
+    literals = [first for first in firsts if first is not None]
+    return len(literals) < len(firsts) or len(set(literals)) < len(literals)
+
+
+def find_unsafe_constructs(pattern):
+    """
+    Returns a description of every construct in the pattern that can make matching take
+    super-linear time: a group repeated without bound that itself contains an unbounded
+    repetition, like (a+)+ or (\\w+\\s?)*, or alternatives that can start with the same
+    character, like (a|aa)+. An empty list means the pattern is considered safe.
+    """
+    problems = []
+    # Open groups as [start position, contains an unbounded repetition, first token of each alternative]
+    groups = [[0, False, [first_token(pattern, 0)]]]
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '(':
+            start = pos
+            pos += 1
+            if pattern[pos:pos + 1] == '?':
+                pos = skip_group_prefix(pattern, pos + 1)
+            groups.append([start, False, [first_token(pattern, pos)]])
+            continue
+
+        if char == '|':
+            groups[-1][2].append(first_token(pattern, pos + 1))
+            pos += 1
+            continue
+
+        if char == ')':
+            start, contains_unbounded, firsts = groups.pop() if len(groups) > 1 else groups[0]
+            unbounded, pos = read_quantifier(pattern, pos + 1)
+            if unbounded and contains_unbounded:
+                problems.append(f"nested unbounded repetition in the group at position {start}")
+            elif unbounded and len(firsts) > 1 and alternatives_overlap(firsts):
+                problems.append(f"repeated alternatives starting alike in the group at position {start}")
+            groups[-1][1] = groups[-1][1] or contains_unbounded or bool(unbounded)
+            continue
+
+        if char == '\\':
+            pos += 2
+        elif char == '[':
+            pos = skip_class(pattern, pos)
+        else:
+            pos += 1
+        unbounded, pos = read_quantifier(pattern, pos)
+        if unbounded:
+            groups[-1][1] = True
+    return problems
+
+
+def is_safe(pattern):
+    """Returns True if the pattern has no construct prone to catastrophic backtracking."""
+    return not find_unsafe_constructs(pattern)
+
+
+def _match_worker(connection):
+    """Runs in the worker process, answers (pattern, value) requests until the pipe is closed."""
+    patterns = {}
+    connection.send(True)  # Ready, the startup is not counted against the first match
+    while True:
+        try:
+            pattern, value = connection.recv()
+        except EOFError:
+            break
+        try:
+            compiled = patterns.get(pattern)
+            if compiled is None:
+                compiled = patterns[pattern] = re.compile(pattern)
+            connection.send((True, compiled.match(value) is not None))
+        except Exception as e:
+            connection.send((False, e))
+
+
+class GuardedMatcher:
+    """
+    Runs regex matches in a separate worker process with a deadline per match.
+    A match that misses the deadline kills the worker, which is restarted on the next match,
+    and raises RegexTimeoutError so only that record fails. The deadline starts once the worker
+    reported that it is ready, so a slow start (spawn or forkserver) does not fail the match.
+    Keeps counters of guarded matches and timeouts for the metrics.
+    """
+    def __init__(self, timeout=0.1, start_method=None):
+        self.timeout = timeout
+        self._context = multiprocessing.get_context(start_method)
+        self.matches = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self._started = False
+        self._process = None
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def match(self, pattern, value):
+        """Returns whether re.match(pattern, value) matches, raises RegexTimeoutError past the deadline."""
+        with self._lock:
+            if self._process is None:
+                self._start()
+            self._connection.send((pattern, value))
+            if not self._connection.poll(self.timeout):
+                self.timeouts += 1
+                self._stop()
+                raise RegexTimeoutError(f"Regex {pattern!r} timed out after {self.timeout} seconds")
+            succeeded, result = self._connection.recv()
+            self.matches += 1
+        if not succeeded:
+            raise result
+        return result
+
+    def _start(self):
+        if self._started:
+            self.restarts += 1
+        self._started = True
+        self._connection, worker_connection = self._context.Pipe()
+        self._process = self._context.Process(target=_match_worker, args=(worker_connection,), daemon=True)
+        self._process.start()
+        worker_connection.close()
+        try:
+            ready = self._connection.poll(START_TIMEOUT) and self._connection.recv()
+        except EOFError:  # The worker exited while starting
+            ready = False
+        if not ready:
+            self._stop()
+            raise RuntimeError(f"Regex worker process did not start within {START_TIMEOUT} seconds")
+
+    def _stop(self):
+        self._process.kill()
+        self._process.join()
+        self._connection.close()
+        self._process = None
+
+    def close(self):
+        """Stops the worker process."""
+        with self._lock:
+            if self._process is not None:
+                self._connection.close()
+                self._process.join(timeout=1)
+                if self._process.is_alive():
+                    self._process.kill()
+                self._process = None
+
+    def stats(self):
+        """Returns the counters as a dictionary."""
+        return {
+            "guarded_matches": self.matches,
+            "timeouts": self.timeouts,
+            "worker_restarts": self.restarts,
+        }
+
+
+class GuardedPattern:
+    """
+    Stands in for a compiled pattern that is unsafe to run inline.
+    Its match method returns a bool instead of a match object.
+    """
+    def __init__(self, pattern, guard):
+        self.pattern = pattern
+        self.guard = guard
+
+    def match(self, value):
+        return self.guard.match(self.pattern, value)
@@ -0,0 +1,1003 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from backfill import BackfillError, iter_batches, run_backfill, split_ranges
+from codegen import SourceGenerator
+from compiler import CompiledExpression, ExpressionCache
+from database import SQLiteDataSink, read_checkpoint
+from django_database import AssetRegistry, ExpressionMap
+from interpreter import *
+from file_watcher import InotifyWatcher, PollingWatcher
+from Main import DataProcessor, FileReader, ShardedProcessor, process_message
+from metrics import Histogram, MetricsExporter, PipelineMetrics
+from optimizer import Optimizer
+from pipeline import OutputBuffer, StagedPipeline
+from records import RecordDecoder, get_json_loads
+import records
+from regex_cache import MultiPatternMatcher, PatternCache, literal_prefix
+from regex_guard import GuardedMatcher, GuardedPattern, RegexTimeoutError, find_unsafe_constructs
+import regex_guard
+import vectorized
+
+
+def make_message(value, asset_id="123", attribute_id="101", timestamp="2022-07-31T23:28:37Z[UTC]"):
+    """Builds a raw input record the same way data.txt stores them."""
+    return json.dumps({
+        "asset_id": asset_id,
+        "attribute_id": attribute_id,
+        "timestamp": timestamp,
+        "value": value
+    })
+
+
+class LexerTest(unittest.TestCase):
+    def tokens(self, text):
+        return [(token.type, token.value) for token in Lexer(text).tokens]
+
+    def test_tokens(self):
+        """The lexer produces the same tokens for the existing grammar."""
+        self.assertEqual(self.tokens('Regex(ATTR, "^dog")'), [
+            (REGEX, 'Regex'), (LPAREN, '('), (ATTR, 'ATTR'), (COMMA, ','), (STRING, '^dog'), (RPAREN, ')')
+        ])
+        self.assertEqual(self.tokens(" ATTR+50*(ATTR/10) "), [
+            (ATTR, 'ATTR'), (PLUS, '+'), (INTEGER, 50), (MUL, '*'), (LPAREN, '('),
+            (ATTR, 'ATTR'), (DIV, '/'), (INTEGER, 10), (RPAREN, ')')
+        ])
+
+    def test_float_literals(self):
+        """Float literals are tokenized and evaluated."""
+        self.assertEqual(self.tokens("1.5*.5+2."), [(FLOAT, 1.5), (MUL, '*'), (FLOAT, 0.5), (PLUS, '+'), (FLOAT, 2.0)])
+        self.assertEqual(CompiledExpression("ATTR*1.5").evaluate(4.0), 6.0)
+
+    def test_positional_errors(self):
+        """Lexical errors say what is wrong and where."""
+        with self.assertRaisesRegex(LexerError, "Invalid character '\\$' at position 4"):
+            Lexer("ATTR$2")
+        with self.assertRaisesRegex(LexerError, "Unknown identifier 'foo' at position 5"):
+            Lexer("ATTR+foo")
+        with self.assertRaisesRegex(LexerError, "Unterminated string starting at position 12"):
+            Lexer('Regex(ATTR, "^dog')
+
+
+class ParserTest(unittest.TestCase):
+    def test_attr_is_not_baked_into_tree(self):
+        """ATTR is parsed into an Attr node instead of a Num holding the value."""
+        tree = Parser(Lexer("ATTR*2")).parse()
+        self.assertIsInstance(tree.left, Attr)
+        self.assertEqual(Interpreter(None, 3.0).visit(tree), 6.0)
+        self.assertEqual(Interpreter(None, 4.0).visit(tree), 8.0)
+
+
+class ExpressionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ExpressionCache(maxsize=2)
+
+    def test_hits_and_misses(self):
+        """The second lookup of an expression is served from the cache."""
+        first = self.cache.get("ATTR+50*(ATTR/10)")
+        second = self.cache.get("ATTR+50*(ATTR/10)")
+        self.assertIs(first, second)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        """The least recently used expression is evicted first."""
+        self.cache.get("ATTR*1")
+        self.cache.get("ATTR*2")
+        self.cache.get("ATTR*1")
+        self.cache.get("ATTR*3")
+        self.assertIn("ATTR*1", self.cache)
+        self.assertNotIn("ATTR*2", self.cache)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_invalid_expression_is_not_cached(self):
+        """Expressions that fail to parse raise and leave the cache untouched."""
+        with self.assertRaises(Exception):
+            self.cache.get("ATTR+")
+        self.assertNotIn("ATTR+", self.cache)
+
+
+class ProcessMessageTest(unittest.TestCase):
+    def test_arithmetic_equation(self):
+        """Arithmetic equations are evaluated on the numeric value."""
+        output = process_message(make_message("10"), "ATTR+50*(ATTR/10)", ExpressionCache())
+        self.assertEqual(output["value"], 60.0)
+        self.assertEqual(output["attribute_id"], "output_101")
+
+    def test_regex_equation(self):
+        """Regex equations are matched against the raw value."""
+        cache = ExpressionCache()
+        self.assertEqual(process_message(make_message("dog_bark"), 'Regex(ATTR, "^dog")', cache)["value"], "True")
+        self.assertEqual(process_message(make_message("cat_meow"), 'Regex(ATTR, "^dog")', cache)["value"], "False")
+        self.assertEqual(cache.misses, 1)
+
+    def test_non_numeric_value(self):
+        """Non-numeric values cannot be used in arithmetic equations."""
+        with self.assertRaisesRegex(Exception, "Non-numeric value"):
+            process_message(make_message("dog_bark"), "ATTR*2", ExpressionCache())
+
+    def test_unlinked_asset(self):
+        """Assets without an expression are reported as not linked."""
+        with self.assertRaisesRegex(Exception, "not linked"):
+            process_message(make_message("10"), None, ExpressionCache())
+
+    def test_invalid_regex_in_batch_mode(self):
+        """A pattern that does not compile fails its own records in batch mode, the others are matched."""
+        expressions = {"123": 'Regex(ATTR, "(")', "124": 'Regex(ATTR, "^dog")'}
+        records = [make_message("dog_bark", "123"), make_message("dog_bark", "124")]
+        sink = ListDataSink()
+        metrics = PipelineMetrics()
+        with mock.patch("Main.get_expression", expressions.get), mock.patch("builtins.print"):
+            DataProcessor(sink, batch_mode=True, metrics=metrics).process_records(records)
+        self.assertEqual([(message["asset_id"], message["value"]) for message in sink.messages], [("124", "True")])
+        self.assertEqual(metrics.errors, {("123", 'Regex(ATTR, "(")'): 1})
+
+
+class RecordDecoderTest(unittest.TestCase):
+    def decoders(self):
+        names = ["json"] + [name for name in ("orjson", "msgspec") if getattr(records, name) is not None]
+        return [RecordDecoder(name) for name in names]
+
+    def test_decode(self):
+        """Every JSON parser gives the same Record."""
+        line = make_message("10")
+        for decoder in self.decoders():
+            record = decoder.decode(line)
+            self.assertEqual((record.raw, record.asset_id, record.attribute_id, record.value),
+                             (line, "123", "101", "10"), decoder.name)
+
+    def test_invalid_records(self):
+        for decoder in self.decoders():
+            with self.assertRaises(KeyError):
+                decoder.decode('{"asset_id": "123"}')
+            with self.assertRaises(ValueError):
+                decoder.decode('[1, 2]')
+            with self.assertRaises(ValueError):
+                decoder.decode('{"asset_id": ')
+
+    def test_unknown_decoder(self):
+        with self.assertRaises(ValueError):
+            get_json_loads("yaml")
+
+    def test_records_are_decoded_once(self):
+        decoder = RecordDecoder("json")
+        decoder.loads = mock.Mock(wraps=json.loads)
+        with mock.patch("Main.get_expression", {"123": "ATTR*2"}.get), mock.patch("builtins.print"):
+            DataProcessor(ListDataSink(), decoder=decoder).process_records([make_message("1"), make_message("2")])
+        self.assertEqual(decoder.loads.call_count, 2)
+
+
+class OptimizerTest(unittest.TestCase):
+    values = [3.0, 0.0, -0.0, -7.5, 1e308, 5e-324, float("inf"), float("nan")]
+    expressions = [
+        "ATTR+50*(ATTR/10)", "(3+4)*ATTR/1", "2*ATTR*4*1-0", "1*(ATTR+0)", "ATTR*2*3",
+        "8*(ATTR*2)", "ATTR/(2-2)", "ATTR*(10/4)", "(ATTR-0)*1+0",
+    ]
+
+    def test_results_unchanged(self):
+        """Optimized trees give the same value, sign of zero included, or the same error."""
+        for expression in self.expressions:
+            original = CompiledExpression(expression, optimize=False)
+            optimized = CompiledExpression(expression)
+            for value in self.values:
+                try:
+                    expected = repr(original.evaluate(value))
+                except Exception as e:
+                    expected = repr(e)
+                try:
+                    actual = repr(optimized.evaluate(value))
+                except Exception as e:
+                    actual = repr(e)
+                self.assertEqual(actual, expected, f"{expression} with {value}")
+
+    def test_nodes_removed(self):
+        """Folding, identities and power of two reassociation are counted."""
+        self.assertEqual(CompiledExpression("(3+4)*ATTR/1").nodes_removed, 4)
+        self.assertEqual(CompiledExpression("2*ATTR*4").nodes_removed, 2)
+        self.assertEqual(CompiledExpression("ATTR+0").nodes_removed, 0)
+        self.assertEqual(CompiledExpression("ATTR*3*5").nodes_removed, 0)
+
+    def test_regex_mode_keeps_identities(self):
+        """In regex mode ATTR is a string, so identities are not applied."""
+        tree = Parser(Lexer("ATTR-0")).parse()
+        optimizer = Optimizer(numeric_attr=False)
+        optimizer.optimize(tree)
+        self.assertEqual(optimizer.nodes_removed, 0)
+
+
+def random_expression(rng, depth):
+    """Builds a random expression accepted by the Parser."""
+    if depth == 0 or rng.random() < 0.3:
+        return rng.choice(["ATTR", str(rng.randint(0, 20)), str(rng.randint(0, 40) / 8)])
+    left = random_expression(rng, depth - 1)
+    right = random_expression(rng, depth - 1)
+    expression = f"{left}{rng.choice('+-*/')}{right}"
+    return f"({expression})" if rng.random() < 0.5 else expression
+
+
+class VirtualMachineTest(unittest.TestCase):
+    values = [3.0, 0.0, -0.0, -7.5, 1e308, float("inf"), float("nan")]
+
+    def evaluate(self, compiled, value):
+        """Returns the repr of the result or of the raised error."""
+        try:
+            return repr(compiled.evaluate(value))
+        except Exception as e:
+            return repr(e)
+
+    def test_matches_interpreter(self):
+        """The VM gives the same result or error as the Interpreter on random expressions."""
+        rng = random.Random(1234)
+        for _ in range(300):
+            expression = random_expression(rng, 5)
+            for optimize in (False, True):
+                interpreter = CompiledExpression(expression, optimize=optimize)
+                vm = CompiledExpression(expression, optimize=optimize, backend="vm")
+                for value in self.values:
+                    self.assertEqual(self.evaluate(vm, value), self.evaluate(interpreter, value),
+                                     f"{expression} with {value}")
+
+    def test_regex(self):
+        """Regex expressions are matched against the raw value."""
+        vm = CompiledExpression('Regex(ATTR, "^dog")', backend="vm")
+        self.assertEqual(vm.evaluate("dog_bark"), "True")
+        self.assertEqual(vm.evaluate("cat_meow"), "False")
+
+    def test_deep_expression(self):
+        """Expressions deeper than the recursion limit can be evaluated."""
+        vm = CompiledExpression("+".join(["ATTR"] * 5000), backend="vm")
+        self.assertEqual(vm.evaluate(2.0), 10000.0)
+
+
+class CodegenTest(unittest.TestCase):
+    values = VirtualMachineTest.values
+
+    def test_matches_interpreter(self):
+        """Generated functions give the same result or error as the Interpreter on random expressions."""
+        rng = random.Random(4321)
+        for _ in range(300):
+            expression = random_expression(rng, 5)
+            for optimize in (False, True):
+                interpreter = CompiledExpression(expression, optimize=optimize)
+                codegen = CompiledExpression(expression, optimize=optimize, backend="codegen")
+                self.assertEqual(codegen.backend, "codegen")
+                for value in self.values:
+                    self.assertEqual(VirtualMachineTest.evaluate(self, codegen, value),
+                                     VirtualMachineTest.evaluate(self, interpreter, value),
+                                     f"{expression} with {value}")
+
+    def test_regex(self):
+        """Regex expressions give the same strings as the Interpreter."""
+        codegen = CompiledExpression('Regex(ATTR, "^dog")', backend="codegen")
+        self.assertEqual(codegen.evaluate("dog_bark"), "True")
+        self.assertEqual(codegen.evaluate("cat_meow"), "False")
+
+    def test_patterns_are_not_in_source(self):
+        """Regex patterns are passed through the namespace, never written into the source."""
+        generator = SourceGenerator()
+        pattern = "('), __import__('os'), ('x')"
+        source = generator.generate(Parser(Lexer(f'Regex(ATTR, "{pattern}")')).parse())
+        self.assertNotIn("import", source)
+        self.assertIn(pattern, [value.__self__.pattern for value in generator.namespace.values()
+                                if hasattr(value, "__self__")])
+
+    def test_rejects_unknown_nodes(self):
+        """Only the node types produced by the Parser are accepted."""
+        with self.assertRaises(Exception):
+            SourceGenerator().generate(Token(INTEGER, 1))
+
+    def test_deep_expression_falls_back_to_vm(self):
+        """Expressions too deep for the Python compiler are evaluated by the VM."""
+        compiled = CompiledExpression("+".join(["ATTR"] * 5000), backend="codegen")
+        self.assertEqual(compiled.backend, "vm")
+        self.assertEqual(compiled.evaluate(2.0), 10000.0)
+
+
+class RegexCacheTest(unittest.TestCase):
+    patterns = ["^dog", "dog_bark", "^cat$", "^ca+t", r"^\d+", "x|dog", r"^a\.b", "^do?g", "", "^dog(bark)?", "c[a-z]t"]
+    values = ["dog_bark", "dog", "cat", "caat", "12x", "a.b", "axb", "dg", "", "ct", "cot_meow"]
+
+    def test_pattern_cache(self):
+        """Compiled patterns are cached and evicted least recently used first."""
+        cache = PatternCache(maxsize=2)
+        self.assertIs(cache.get("^dog"), cache.get("^dog"))
+        cache.get("^cat")
+        cache.get("^cow")
+        self.assertEqual((len(cache), cache.hits, cache.misses), (2, 1, 3))
+
+    def test_literal_prefix(self):
+        """Literal prefixes stop at the first construct that is not plain text."""
+        self.assertEqual(literal_prefix("^dog"), ("dog", True))
+        self.assertEqual(literal_prefix("dog$"), ("dog", False))
+        self.assertEqual(literal_prefix("^ca+t"), ("c", False))
+        self.assertEqual(literal_prefix(r"a\.b\d"), ("a.b", False))
+        self.assertEqual(literal_prefix("dog|cat"), ("", False))
+
+    def test_matches_re(self):
+        """The multi-pattern matcher agrees with re.match for every pattern and value."""
+        matcher = MultiPatternMatcher(self.patterns)
+        for value in self.values:
+            results = matcher.match_all(value)
+            for pattern in self.patterns:
+                self.assertEqual(results[pattern], bool(re.match(pattern, value)), f"{pattern} with {value}")
+
+
+class RegexGuardTest(unittest.TestCase):
+    def test_unsafe_constructs(self):
+        """Groups repeated without bound that contain unbounded repetitions or overlapping alternatives are reported."""
+        for pattern in [r"(a+)+$", r"^(\w+\s?)*$", r"(?:a*b*)*c", r"((ab)*c)+", r"(a|a)*", r"(a|aa)+$", r"(.|x)+"]:
+            self.assertTrue(find_unsafe_constructs(pattern), pattern)
+        for pattern in [r"^dog", r"(\d+\.){3}\d+", r"(a|b)*", r"\(a+\)+", r"[(]+a+", r"(a+)?", r"(?:cat|dog)+",
+                        r"(a|aa){2}", r"[a|a]+"]:
+            self.assertEqual(find_unsafe_constructs(pattern), [], pattern)
+
+    def test_unsafe_patterns_are_guarded(self):
+        """The pattern cache hands out guarded patterns for unsafe regexes only."""
+        cache = PatternCache(guard=GuardedMatcher())
+        self.assertIsInstance(cache.get(r"(a+)+$"), GuardedPattern)
+        self.assertIsInstance(cache.get(r"(a|a)*"), GuardedPattern)
+        self.assertIsInstance(cache.get(r"(a|aa)+$"), GuardedPattern)
+        self.assertNotIsInstance(cache.get(r"^dog"), GuardedPattern)
+
+    def test_timeout(self):
+        """A catastrophic match times out, and the guard keeps working afterwards."""
+        guard = GuardedMatcher(timeout=0.5)
+        try:
+            self.assertTrue(guard.match(r"(a+)+$", "aaaa"))
+            with self.assertRaises(RegexTimeoutError):
+                guard.match(r"(a+)+$", "a" * 40 + "b")
+            self.assertFalse(guard.match(r"(a+)+$", "b"))
+            self.assertEqual(guard.stats(), {"guarded_matches": 2, "timeouts": 1, "worker_restarts": 1})
+        finally:
+            guard.close()
+
+    @unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "fork is not available")
+    def test_startup_is_outside_the_deadline(self):
+        """A worker taking longer to start than the deadline still gets its first match right."""
+        match_worker = regex_guard._match_worker
+
+        def slow_worker(connection):
+            time.sleep(1.0)  # A slow start, like a spawned process importing the engine
+            match_worker(connection)
+
+        # The forked worker runs the patched function, a spawned one would import the original
+        guard = GuardedMatcher(timeout=0.5, start_method="fork")
+        try:
+            with mock.patch("regex_guard._match_worker", slow_worker):
+                self.assertTrue(guard.match(r"(a+)+$", "aaaa"))
+            self.assertFalse(guard.match(r"(a+)+$", "b"))
+            self.assertEqual(guard.stats()["timeouts"], 0)
+        finally:
+            guard.close()
+
+
+class ListDataSink:
+    """Data sink that keeps the written messages in memory."""
+    def __init__(self):
+        self.messages = []
+
+    def write_message(self, message):
+        self.messages.append(message)
+
+
+@unittest.skipUnless(vectorized.available, "NumPy is not installed")
+class VectorizedTest(unittest.TestCase):
+    values = [10.0, 0.0, -3.5, 1e308, float("inf"), 7.25]
+
+    def assert_matches_interpreter(self, expression):
+        """Every element must get the value or the error the Interpreter gives it."""
+        tree = CompiledExpression(expression).tree
+        for value, (result, error) in zip(self.values, vectorized.evaluate_batch(tree, self.values)):
+            try:
+                expected = Interpreter(None, value).visit(tree)
+            except Exception as e:
+                self.assertEqual(str(error), str(e), f"{expression} with {value}")
+                continue
+            self.assertIsNone(error)
+            self.assertEqual(repr(result), repr(expected), f"{expression} with {value}")
+
+    def test_matches_interpreter(self):
+        """Vectorized results are identical to the Interpreter's, including division by zero."""
+        for expression in ["ATTR+50*(ATTR/10)", "ATTR*4", "10/ATTR", "(ATTR-ATTR)/(ATTR-10)", "7/2-ATTR", "3*4", "ATTR/0"]:
+            self.assert_matches_interpreter(expression)
+
+    def test_constant_error_fails_every_value(self):
+        """An error in a constant subtree is reported for every value."""
+        results = vectorized.evaluate_batch(CompiledExpression("ATTR+1/0").tree, [1.0, 2.0])
+        self.assertTrue(all(isinstance(error, ZeroDivisionError) for _, error in results))
+
+    def test_batch_mode_matches_record_mode(self):
+        """DataProcessor writes the same outputs in batch mode as record by record."""
+        expressions = {"123": "ATTR+50*(ATTR/10)", "124": 'Regex(ATTR, "^dog")', "125": "100/ATTR"}
+        records = [
+            make_message("10", "123"), make_message("dog_bark", "124"), make_message("0", "125"),
+            make_message("cat", "123"), make_message("4", "125"), make_message("20", "123"),
+        ]
+        outputs = []
+        for batch_mode in (False, True):
+            sink = ListDataSink()
+            with mock.patch("Main.get_expression", expressions.get), mock.patch("builtins.print"):
+                DataProcessor(sink, batch_mode=batch_mode).process_records(records)
+            outputs.append(sorted(sink.messages, key=lambda message: (message["asset_id"], str(message["value"]))))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(len(outputs[1]), 4)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram_buckets(self):
+        """Bucket counts are cumulative and a value on a bound falls in that bucket."""
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative_counts(), [(0.1, 2), (1.0, 3), ('+Inf', 4)])
+        self.assertEqual(histogram.count, 4)
+
+    def test_process_records(self):
+        """Stages, outputs and errors per asset and KPI are counted."""
+        metrics = PipelineMetrics()
+        expressions = {"123": "ATTR*2"}
+        records = [make_message("10", "123"), make_message("cat", "123"), make_message("1", "999")]
+        with mock.patch("Main.get_expression", expressions.get), mock.patch("builtins.print"):
+            DataProcessor(ListDataSink(), metrics=metrics).process_records(records)
+        self.assertEqual((metrics.records_read, metrics.records_processed, metrics.records_failed), (3, 1, 2))
+        self.assertEqual(metrics.errors, {("123", "ATTR*2"): 1, ("999", "None"): 1})
+        self.assertEqual(metrics.stages["decode"].count, 3)  # Once per record
+        self.assertEqual(metrics.stages["lookup"].count, 3)
+        self.assertEqual(metrics.stages["expression_cache"].count, 1)
+        self.assertEqual(metrics.stages["evaluate"].count, 1)
+        self.assertEqual(metrics.stages["write"].count, 1)
+
+    def test_errors_from_several_threads(self):
+        """Errors recorded by several threads while exporting are all counted."""
+        metrics = PipelineMetrics()
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # Switches threads often enough for races to show up
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        def record_errors(thread):
+            for i in range(2000):
+                metrics.record_error(f"{thread}-{i % 50}", "ATTR*2")
+
+        threads = [threading.Thread(target=record_errors, args=(thread,)) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            metrics.snapshot()
+            metrics.prometheus_text()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.records_failed, 8000)
+        self.assertEqual(sum(metrics.errors.values()), 8000)
+
+    def test_exporter(self):
+        """The Prometheus and JSON files hold the metrics and the registered collectors."""
+        metrics = PipelineMetrics()
+        metrics.record_error("123", 'Regex(ATTR, "^a\\"")')
+        metrics.add_collector("expression_cache", ExpressionCache().stats)
+        with tempfile.TemporaryDirectory() as directory:
+            prometheus_file = os.path.join(directory, "metrics.prom")
+            json_file = os.path.join(directory, "metrics.json")
+            MetricsExporter(metrics, prometheus_file, json_file).write_if_due()
+            with open(prometheus_file) as file:
+                text = file.read()
+            with open(json_file) as file:
+                snapshot = json.load(file)
+        self.assertIn('kpi_stage_duration_seconds_bucket{stage="decode",le="+Inf"} 0', text)
+        self.assertIn('kpi_errors_total{asset_id="123",kpi="Regex(ATTR, \\"^a\\\\\\"\\")"} 1', text)
+        self.assertIn("# TYPE kpi_expression_cache_misses_total counter\nkpi_expression_cache_misses_total 0", text)
+        self.assertIn("# HELP kpi_expression_cache_size Size of the expression cache.", text)
+        self.assertIn("# TYPE kpi_expression_cache_size gauge", text)
+        self.assertNotIn("kpi_expression_cache_backend", text)
+        self.assertEqual(snapshot["records_failed"], 1)
+        self.assertEqual(snapshot["expression_cache"]["backend"], "interpreter")
+
+
+class SQLiteDataSinkTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_name = os.path.join(directory.name, "output.db")
+
+    def committed_rows(self):
+        """Counts the rows visible to another connection."""
+        connection = sqlite3.connect(self.db_name)
+        try:
+            return connection.execute("SELECT COUNT(*) FROM processed_data").fetchone()[0]
+        finally:
+            connection.close()
+
+    def output(self, value, timestamp=None):
+        timestamp = str(value) if timestamp is None else timestamp
+        return {"asset_id": "123", "attribute_id": "output_101", "timestamp": timestamp, "value": value}
+
+    def rows(self):
+        connection = sqlite3.connect(self.db_name)
+        try:
+            return connection.execute("SELECT timestamp, value FROM processed_data ORDER BY timestamp").fetchall()
+        finally:
+            connection.close()
+
+    def test_size_based_flush(self):
+        """Messages are committed once batch_size of them are pending, and on close."""
+        sink = SQLiteDataSink(self.db_name, batch_size=3, flush_interval=60, wal=True, synchronous="normal")
+        for value in range(4):
+            sink.write_message(self.output(value))
+        self.assertEqual(self.committed_rows(), 3)
+        self.assertEqual(sink.stats()["pending"], 1)
+        sink.close()
+        self.assertEqual(self.committed_rows(), 4)
+
+    def test_time_based_flush(self):
+        """flush_if_due commits the pending messages once the oldest has waited flush_interval."""
+        sink = SQLiteDataSink(self.db_name, batch_size=100, flush_interval=60)
+        try:
+            sink.write_message(self.output(1))
+            sink.flush_if_due()
+            self.assertEqual(self.committed_rows(), 0)
+            sink.flush_interval = 0
+            sink.flush_if_due()
+            self.assertEqual(self.committed_rows(), 1)
+        finally:
+            sink.close()
+
+    def test_checkpoint(self):
+        """The reader position is committed with the outputs of its batch, never before them."""
+        sink = SQLiteDataSink(self.db_name, batch_size=2, flush_interval=60, checkpoint_source="data.txt")
+        try:
+            for value in range(3):
+                sink.write_message(self.output(value))
+            self.assertEqual(self.committed_rows(), 0)
+            self.assertIsNone(read_checkpoint(self.db_name, "data.txt"))
+            sink.checkpoint((7, 30))
+            self.assertEqual(self.committed_rows(), 3)
+            self.assertEqual(read_checkpoint(self.db_name, "data.txt"), (7, 30))
+
+            sink.checkpoint_interval = 60
+            sink.write_message(self.output(3))
+            sink.write_message(self.output(4))
+            sink.checkpoint((7, 50))
+            self.assertEqual(self.committed_rows(), 5)
+            self.assertEqual(read_checkpoint(self.db_name, "data.txt"), (7, 30))
+        finally:
+            sink.close()
+        self.assertEqual(read_checkpoint(self.db_name, "data.txt"), (7, 50))
+        self.assertIsNone(read_checkpoint(self.db_name, "other.txt"))
+
+    def test_outputs_after_the_last_checkpoint(self):
+        """Outputs not covered by a checkpoint are never committed, their input is read again after a restart."""
+        sink = SQLiteDataSink(self.db_name, batch_size=100, flush_interval=0, checkpoint_source="data.txt")
+        try:
+            sink.write_message(self.output(0))
+            sink.checkpoint((7, 10))
+            sink.write_message(self.output(1))  # Part of a batch still being written
+            sink.flush_if_due()
+            self.assertEqual(self.committed_rows(), 1)
+            self.assertEqual(sink.stats()["pending"], 1)
+        finally:
+            sink.close()
+        self.assertEqual(self.rows(), [("0", "0")])
+        self.assertEqual(read_checkpoint(self.db_name, "data.txt"), (7, 10))
+
+    def test_replays_are_not_duplicated(self):
+        """A key is stored once, with the last value written, whether or not the replay is remembered."""
+        for recent_keys in (100, 0):
+            sink = SQLiteDataSink(self.db_name, recent_keys=recent_keys)
+            for value in (1, 2, 1, 2):
+                sink.write_message(self.output(value))
+            sink.write_message(self.output(3, timestamp="1"))
+            sink.close()
+            self.assertEqual(self.rows(), [("1", "3"), ("2", "2")])
+            self.assertEqual(sink.stats()["duplicates_dropped"], 2 if recent_keys else 0)
+
+    def test_existing_duplicates_are_removed(self):
+        execute_sql(self.db_name,
+                    "CREATE TABLE processed_data (asset_id TEXT, attribute_id TEXT, timestamp TEXT, value TEXT)",
+                    "INSERT INTO processed_data VALUES ('123', 'output_101', '1', 'a'), ('123', 'output_101', '1', 'b')")
+        SQLiteDataSink(self.db_name).close()
+        self.assertEqual(self.rows(), [("1", "b")])
+
+    def test_unknown_synchronous_mode(self):
+        with self.assertRaises(ValueError):
+            SQLiteDataSink(self.db_name, synchronous="fast")
+
+
+def execute_sql(db_name, *statements):
+    """Runs statements on a separate connection, like the Django application does."""
+    connection = sqlite3.connect(db_name)
+    try:
+        for statement in statements:
+            connection.execute(statement)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def create_kpi_tables(db_name):
+    """Creates the tables of the kpi app with two KPIs, asset 123 is linked to both and registered."""
+    execute_sql(
+        db_name,
+        "CREATE TABLE kpi_kpi (id INTEGER PRIMARY KEY, name TEXT, expression TEXT)",
+        "CREATE TABLE kpi_assetkpi (id INTEGER PRIMARY KEY, asset_id TEXT, kpi_id INTEGER)",
+        "CREATE TABLE kpi_asset (id INTEGER PRIMARY KEY, asset_id TEXT UNIQUE, "
+        "first_seen TEXT DEFAULT CURRENT_TIMESTAMP)",
+        "INSERT INTO kpi_asset (asset_id) VALUES ('123')",
+        "INSERT INTO kpi_kpi VALUES (1, 'double', ' ATTR*2 '), (2, 'dog', 'Regex(ATTR, \"^dog\")')",
+        "INSERT INTO kpi_assetkpi VALUES (1, '123', 1), (2, '124', 2), (3, '123', 2)",
+    )
+
+
+class ExpressionMapTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_name = os.path.join(directory.name, "django.db")
+        create_kpi_tables(self.db_name)
+        self.expressions = ExpressionMap(self.db_name, check_interval=0)
+        self.addCleanup(self.expressions.close)
+
+    def execute(self, *statements):
+        execute_sql(self.db_name, *statements)
+
+    def test_lookup(self):
+        """Assets get the stripped expression of the first KPI linked to them."""
+        self.assertEqual(self.expressions.get("123"), "ATTR*2")
+        self.assertEqual(self.expressions.get("124"), 'Regex(ATTR, "^dog")')
+        self.assertIsNone(self.expressions.get("999"))
+        self.assertEqual(self.expressions.get(123), "ATTR*2")  # A numeric asset_id in the JSON record
+        self.assertEqual(self.expressions.loads, 1)
+
+    def test_reloads_on_change(self):
+        """The map is reloaded only after another connection commits a change."""
+        self.assertIsNone(self.expressions.get("125"))
+        self.expressions.get("123")
+        self.assertEqual(self.expressions.loads, 1)
+        self.execute("INSERT INTO kpi_assetkpi VALUES (4, '125', 1)")
+        self.assertEqual(self.expressions.get("125"), "ATTR*2")
+        self.assertEqual(self.expressions.loads, 2)
+        self.expressions.refresh()
+        self.assertEqual(self.expressions.loads, 3)
+
+
+class AssetRegistryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_name = os.path.join(directory.name, "django.db")
+
+    def registered(self):
+        connection = sqlite3.connect(self.db_name)
+        try:
+            return sorted(asset_id for asset_id, in connection.execute("SELECT asset_id FROM kpi_asset"))
+        finally:
+            connection.close()
+
+    def test_new_assets_are_registered(self):
+        create_kpi_tables(self.db_name)
+        registry = AssetRegistry(self.db_name)
+        self.addCleanup(registry.close)
+        processor = DataProcessor(ListDataSink(), metrics=PipelineMetrics(), asset_registry=registry)
+        with mock.patch("Main.get_expression", {}.get), mock.patch("builtins.print"):
+            processor.process_records([make_message("1", asset_id) for asset_id in ("123", "124", "124", 125)])
+        self.assertEqual(self.registered(), ["123", "124", "125"])
+        self.assertEqual(registry.stats(), {"known": 3, "registered": 2})
+        registry.register(["124"])
+        self.assertEqual(registry.registered, 2)
+
+    def test_disabled_without_table(self):
+        execute_sql(self.db_name, "CREATE TABLE kpi_kpi (id INTEGER PRIMARY KEY)")
+        registry = AssetRegistry(self.db_name)
+        with mock.patch("builtins.print"):
+            registry.register(["123"])
+        self.assertFalse(registry.enabled)
+        registry.register(["123"])
+
+
+class FileReaderTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "data.txt")
+        self.reader = FileReader(self.path)
+        self.addCleanup(self.reader.close)
+
+    def append(self, text, mode="a"):
+        with open(self.path, mode) as file:
+            file.write(text)
+
+    def test_missing_file(self):
+        self.assertEqual(self.reader.read_new_records(), [])
+        self.append("a\n")
+        self.assertEqual(self.reader.read_new_records(), ["a"])
+
+    def test_truncation(self):
+        """A truncated file is read again from its start."""
+        self.append("a\nb\n")
+        self.assertEqual(self.reader.read_new_records(), ["a", "b"])
+        self.append("c\n", mode="w")
+        self.assertEqual(self.reader.read_new_records(), ["c"])
+        self.assertEqual(self.reader.truncations, 1)
+
+    def test_rotation(self):
+        """The rest of a rotated file is read before the new file."""
+        self.append("a\n")
+        self.assertEqual(self.reader.read_new_records(), ["a"])
+        self.append("b\n")
+        os.rename(self.path, self.path + ".1")
+        self.assertEqual(self.reader.read_new_records(), ["b"])
+        self.append("c\nd\n")
+        self.assertEqual(self.reader.read_new_records(), ["c", "d"])
+        self.assertEqual(self.reader.rotations, 1)
+
+    def test_partial_line(self):
+        """A line without its newline is returned once it is completed."""
+        self.append('a\n{"asset_id": ')
+        self.assertEqual(self.reader.read_new_records(), ["a"])
+        self.assertEqual(self.reader.last_position, 2)
+        self.assertEqual(self.reader.read_new_records(), [])
+        self.append('"123"}\r\n')
+        self.assertEqual(self.reader.read_new_records(), ['{"asset_id": "123"}'])
+        self.assertEqual(self.reader.last_position, os.path.getsize(self.path))
+
+    def test_bounded_batches(self):
+        """Records are returned batch_size at a time, reading small chunks."""
+        reader = FileReader(self.path, batch_size=2, chunk_size=3)
+        self.addCleanup(reader.close)
+        self.append("".join(f"{i}\n" for i in range(5)) + "é\n")
+        self.assertEqual(reader.read_new_records(), ["0", "1"])
+        self.assertEqual(reader.last_position, 4)
+        self.assertLessEqual(len(reader.lines), 2)
+        self.assertEqual(reader.read_new_records(), ["2", "3"])
+        self.assertEqual(reader.read_new_records(), ["4", "é"])
+        self.assertEqual(reader.read_new_records(), [])
+        self.assertEqual(reader.unread_bytes(), 0)
+
+    def test_seek(self):
+        """A reader resumes at a position of another reader, unless the file was replaced."""
+        self.append("a\nb\nc\n")
+        reader = FileReader(self.path, batch_size=2)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.read_new_records(), ["a", "b"])
+        inode, offset = reader.position()
+        self.assertEqual(offset, 4)
+        self.assertTrue(self.reader.seek(inode, offset))
+        self.assertEqual(self.reader.read_new_records(), ["c"])
+
+        self.reader.close()
+        os.rename(self.path, self.path + ".1")
+        self.append("d\n")
+        reader = FileReader(self.path)
+        self.addCleanup(reader.close)
+        self.assertFalse(reader.seek(inode, offset))
+        self.assertEqual(reader.read_new_records(), ["d"])
+
+    def test_long_lines_are_skipped(self):
+        reader = FileReader(self.path, chunk_size=4, max_line_length=8)
+        self.addCleanup(reader.close)
+        self.append("a\n" + "x" * 20 + "\nb\n")
+        self.assertEqual(reader.read_new_records(), ["a", "b"])
+        self.assertEqual(reader.skipped_lines, 1)
+        self.assertEqual(reader.unread_bytes(), 0)
+
+
+class FileWatcherTest(unittest.TestCase):
+    def assert_sees_changes(self, make_watcher):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.txt")
+            with open(os.path.join(directory, "other.txt"), "w") as file:
+                file.write("x")
+            watcher = make_watcher(path)
+            try:
+                self.assertFalse(watcher.wait(0.05))
+                with open(path, "a") as file:
+                    file.write("a\n")
+                self.assertTrue(watcher.wait(1))
+                os.rename(path, path + ".1")
+                self.assertTrue(watcher.wait(1))
+            finally:
+                watcher.close()
+
+    def test_polling(self):
+        self.assert_sees_changes(lambda path: PollingWatcher(path, min_interval=0.001, max_interval=0.01))
+
+    def test_inotify(self):
+        try:
+            InotifyWatcher(tempfile.gettempdir()).close()
+        except OSError:
+            self.skipTest("inotify is not available")
+        self.assert_sees_changes(InotifyWatcher)
+
+
+class ShardedProcessorTest(unittest.TestCase):
+    def test_matches_single_process(self):
+        """Worker processes write the outputs a single process writes, in order per asset."""
+        with tempfile.TemporaryDirectory() as directory:
+            db_name = os.path.join(directory, "django.db")
+            create_kpi_tables(db_name)
+            records = [make_message(value, asset_id) for value in ("dog_bark", "1", "2", "x", "3")
+                       for asset_id in ("123", "124", "125")]
+            outputs = []
+            metrics = []
+            for workers in (0, 2):
+                sink = ListDataSink()
+                metrics.append(PipelineMetrics())
+                with mock.patch("builtins.print"):
+                    if workers:
+                        processor = ShardedProcessor(sink, workers, metrics=metrics[-1], expressions_db=db_name)
+                    else:
+                        processor = DataProcessor(sink, metrics=metrics[-1])
+                    try:
+                        with mock.patch("Main.get_expression", ExpressionMap(db_name).get):
+                            processor.process_records(records)
+                    finally:
+                        processor.close()
+                outputs.append(sorted(sink.messages, key=lambda message: message["asset_id"]))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(len(outputs[1]), 8)
+        self.assertEqual(metrics[0].errors, metrics[1].errors)
+        self.assertEqual(metrics[1].stages["evaluate"].count, 8)
+
+    def test_worker_restart(self):
+        """A worker that exits is restarted and the records it was holding are reported."""
+        with tempfile.TemporaryDirectory() as directory:
+            db_name = os.path.join(directory, "django.db")
+            create_kpi_tables(db_name)
+            sink = ListDataSink()
+            metrics = PipelineMetrics()
+            with mock.patch("builtins.print"):
+                processor = ShardedProcessor(sink, 2, metrics=metrics, expressions_db=db_name)
+                try:
+                    dead = processor.shard("123")
+                    processor.processes[dead].kill()
+                    processor.processes[dead].join()
+                    records = [make_message("1", "123"), make_message("dog_bark", "124")]
+                    processor.process_records(records)
+                    processor.process_records([make_message("2", "123")])
+                finally:
+                    processor.close()
+        self.assertEqual(metrics.errors, {("123", "None"): 1})
+        self.assertEqual(metrics.snapshot()["shards"]["worker_restarts"], 1)
+        self.assertEqual(sorted((message["asset_id"], message["value"]) for message in sink.messages),
+                         [("123", 4.0), ("124", "True")])
+
+
+class ClosingListDataSink(ListDataSink):
+    """ListDataSink with the flush methods of SQLiteDataSink, slowed down to fill the queues."""
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.delay = delay
+        self.closed = False
+
+    def write_message(self, message):
+        time.sleep(self.delay)
+        super().write_message(message)
+
+    def flush_if_due(self):
+        pass
+
+    def checkpoint(self, position):
+        self.position = position
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        self.closed = True
+
+
+class StagedPipelineTest(unittest.TestCase):
+    def run_pipeline(self, lines, sink, queue_size=4, read_batch_size=2):
+        """Runs the pipeline over the lines until the sink got an output per line, then stops it."""
+        depths = []
+
+        async def run(pipeline):
+            task = asyncio.create_task(pipeline.run())
+            while len(sink.messages) < len(lines) and not task.done():
+                depths.append(pipeline.stats()["read_queue_depth"])
+                await asyncio.sleep(0.001)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.txt")
+            with open(path, "w") as file:
+                file.write("".join(line + "\n" for line in lines))
+            reader = FileReader(path, batch_size=read_batch_size)
+            output_buffer = OutputBuffer()
+            processor = DataProcessor(output_buffer, metrics=PipelineMetrics())
+            pipeline = StagedPipeline(reader, PollingWatcher(path), processor, output_buffer, lambda: sink,
+                                      metrics=PipelineMetrics(), queue_size=queue_size, flush_interval=0.01)
+            with mock.patch("Main.get_expression", {"123": "ATTR*2"}.get), mock.patch("builtins.print"):
+                asyncio.run(run(pipeline))
+            reader.close()
+        return depths
+
+    def test_outputs_are_written_in_order(self):
+        lines = [make_message(str(value)) for value in range(10)]
+        sink = ClosingListDataSink()
+        self.run_pipeline(lines, sink)
+        self.assertEqual([message["value"] for message in sink.messages], [value * 2.0 for value in range(10)])
+        self.assertTrue(sink.closed)
+        self.assertEqual(sink.position[1], sum(len(line) + 1 for line in lines))
+
+    def test_backpressure(self):
+        """A slow writer stage keeps the queues bounded."""
+        depths = self.run_pipeline([make_message("1")] * 20, ClosingListDataSink(delay=0.005),
+                                   queue_size=1, read_batch_size=1)
+        self.assertLessEqual(max(depths), 1)
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(self.directory, "data.txt")
+
+    def write_lines(self, lines):
+        with open(self.path, "w") as file:
+            file.write("".join(line + "\n" for line in lines))
+
+    def test_ranges_end_at_newlines(self):
+        lines = [make_message(str(value)) for value in range(50)]
+        self.write_lines(lines)
+        with open(self.path, "rb") as file:
+            data = file.read()
+        ranges = split_ranges(self.path, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[end - 1:end], b"\n")
+        batches = [batch for start, end in ranges for batch in iter_batches(data, start, end, 3)]
+        self.assertEqual([line for _, records in batches for line in records], lines)
+        self.assertEqual(sum(consumed for consumed, _ in batches), len(data))
+        self.assertLessEqual(max(len(records) for _, records in batches), 3)
+
+    def test_more_ranges_than_lines(self):
+        self.write_lines([make_message("1")])
+        self.assertEqual(len(split_ranges(self.path, 8)), 1)
+        self.write_lines([])
+        self.assertEqual(split_ranges(self.path, 8), [])
+
+    def test_backfill(self):
+        """Every line is processed once by the workers and written to the output database."""
+        expressions_db = os.path.join(self.directory, "django.db")
+        output_db = os.path.join(self.directory, "output.db")
+        create_kpi_tables(expressions_db)
+        self.write_lines([make_message(str(value), timestamp=str(value)) for value in range(30)] + ["not json"])
+        with mock.patch("builtins.print"):
+            summary = run_backfill(self.path, workers=2, db_name=output_db, expressions_db=expressions_db,
+                                   read_batch_size=7, report=lambda text: None)
+        self.assertEqual(summary["records"], 31)
+        self.assertEqual(summary["errors"], 1)
+        self.assertEqual(summary["bytes"], os.path.getsize(self.path))
+        connection = sqlite3.connect(output_db)
+        try:
+            values = sorted(float(value) for value, in connection.execute("SELECT value FROM processed_data"))
+        finally:
+            connection.close()
+        self.assertEqual(values, [value * 2.0 for value in range(30)])
+
+    def test_failed_worker(self):
+        """A worker exiting with an error fails the backfill instead of skipping its range."""
+        self.write_lines([make_message(str(value), timestamp=str(value)) for value in range(10)])
+        output_db = os.path.join(self.directory, "output.db")
+        with self.assertRaisesRegex(BackfillError, r"bytes 0-\d+ \(exit code 1\)"):
+            # Every worker fails to create its decoder, printing the traceback on stderr
+            run_backfill(self.path, workers=2, db_name=output_db, json_decoder="unknown", report=lambda text: None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, callers fall back to the Interpreter without it
+    np = None
+
+from interpreter import *
+
+# True when the vectorized evaluator can be used
+available = np is not None
+
+
+class VectorInterpreter(NodeVisitor):
+    """
+    Evaluates an arithmetic AST once over a NumPy array of ATTR values.
+    It applies the same Operation classes as the Interpreter, so each element gets the
+    value the Interpreter would return for it. Elements that divide by zero are flagged
+    in `errors` instead of stopping the whole batch.
+    """
+    def __init__(self, attr_values):
+        self.attr_values = attr_values
+        self.errors = np.zeros(len(attr_values), dtype=bool)
+        self.operations = {
+            'PLUS': AddOperation(),
+            'MINUS': SubOperation(),
+            'MUL': MulOperation(),
+            'DIV': DivOperation()
+        }
+
+    def visit_BinOp(self, node):
+        """
+        Visits a binary operation node and evaluates it element-wise.
+        Constant subtrees are evaluated on Python numbers exactly like the Interpreter does.
+        """
+        operation = self.operations.get(node.op.type)
+        if operation is None:
+            raise ValueError(f"Unsupported operation: {node.op.type}")
+
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if not isinstance(left, np.ndarray) and not isinstance(right, np.ndarray):
+            return operation.apply(left, right)
+
+        if node.op.type == DIV:
+            # Python raises for these elements, NumPy would silently return inf or nan
+            if isinstance(right, np.ndarray):
+                self.errors |= right == 0
+            elif right == 0:
+                self.errors[:] = True
+
+        with np.errstate(all='ignore'):
+            return operation.apply(left, right)
+
+    def visit_Num(self, node):
+        """
+        Visits a number node and returns its value.
+        """
+        return node.value
+
+    def visit_Attr(self, node):
+        """
+        Visits an ATTR node and returns the whole array of attribute values.
+        """
+        return self.attr_values
+
+    def visit_Regex(self, node):
+        raise TypeError("Regex expressions cannot be vectorized")
+
+
+def is_vectorizable(tree):
+    """Returns True if the tree can be evaluated by the VectorInterpreter."""
+    return is_arithmetic(tree)
+
+
+def evaluate_batch(tree, attr_values):
+    """
+    Evaluates an arithmetic tree for every value in attr_values (a sequence of floats).
+    Returns one (result, error) pair per value, in order. error is None on success,
+    otherwise it is the exception the Interpreter would have raised for that value.
+    """
+    values = np.asarray(attr_values, dtype=np.float64)
+    interpreter = VectorInterpreter(values)
+    try:
+        result = interpreter.visit(tree)
+    except Exception as e:  # Raised by a constant subtree, so every value fails the same way
+        return [(None, e)] * len(values)
+
+    if not isinstance(result, np.ndarray):  # The expression does not use ATTR
+        return [(result, None)] * len(values)
+
+    return [
+        (None, ZeroDivisionError("float division by zero")) if failed else (value, None)
+        for value, failed in zip(result.tolist(), interpreter.errors.tolist())
+    ]
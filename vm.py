@@ -0,0 +1,88 @@
+from AST import *
+from regex_cache import pattern_cache
+
+# Instruction opcodes, an instruction is an (opcode, argument) pair.
+# The argument of MATCH_REGEX is the compiled pattern.
+PUSH_CONST, LOAD_ATTR, BINARY_ADD, BINARY_SUB, BINARY_MUL, BINARY_DIV, MATCH_REGEX = range(7)
+
+# maps operation types to the opcode applying them
+BINARY_OPCODES = {
+    'PLUS': BINARY_ADD,
+    'MINUS': BINARY_SUB,
+    'MUL': BINARY_MUL,
+    'DIV': BINARY_DIV
+}
+
+
+def compile_tree(tree):
+    """
+    Compiles an AST into a flat list of postfix instructions.
+    The tree is walked with an explicit stack, so deeply nested expressions
+    do not hit the recursion limit.
+    """
+    code = []
+    stack = [(tree, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if isinstance(node, BinOp):
+            if children_done:
+                code.append((BINARY_OPCODES[node.op.type], None))
+            elif node.op.type not in BINARY_OPCODES:
+                raise ValueError(f"Unsupported operation: {node.op.type}")
+            else:
+                # Left operand is compiled (and evaluated) first, like the Interpreter does
+                stack.append((node, True))
+                stack.append((node.right, False))
+                stack.append((node.left, False))
+        elif isinstance(node, Num):
+            code.append((PUSH_CONST, node.value))
+        elif isinstance(node, Attr):
+            code.append((LOAD_ATTR, None))
+        elif isinstance(node, Regex):
+            code.append((MATCH_REGEX, pattern_cache.get(node.pattern.value)))
+        else:
+            raise Exception(f'No compile rule for {type(node).__name__}')
+    return code
+
+
+def run(code, attr_value):
+    """
+    Runs compiled instructions on a value stack and returns the result.
+    Operators are applied inline with the same semantics as the Operation classes.
+    """
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    for opcode, argument in code:
+        if opcode == PUSH_CONST:
+            push(argument)
+        elif opcode == LOAD_ATTR:
+            push(attr_value)
+        elif opcode == BINARY_ADD:
+            right = pop()
+            stack[-1] = stack[-1] + right
+        elif opcode == BINARY_SUB:
+            right = pop()
+            stack[-1] = stack[-1] - right
+        elif opcode == BINARY_MUL:
+            right = pop()
+            stack[-1] = stack[-1] * right
+        elif opcode == BINARY_DIV:
+            right = pop()
+            stack[-1] = stack[-1] / right
+        else:  # MATCH_REGEX
+            push('True' if argument.match(attr_value) else 'False')
+    return stack[0]
+
+
+class VirtualMachine:
+    """
+    Stack based alternative to the Interpreter.
+    Compiles the AST once and evaluates it with a non-recursive loop.
+    """
+    def __init__(self, tree):
+        self.code = compile_tree(tree)
+
+    def evaluate(self, attr_value):
+        """Evaluates the compiled expression with ATTR bound to attr_value."""
+        return run(self.code, attr_value)